@@ -0,0 +1,10 @@
+import os
+import tempfile
+from pathlib import Path
+
+# main.py resolves templates/static/uploads relative to the working directory and reads
+# DATABASE_URL at import time. Every test module shares the one imported main, so point it
+# at a throwaway database here, before any of them imports it
+os.chdir(Path(__file__).parent)
+os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/test.db"
+os.environ.setdefault("SECRET_KEY", "test-secret")
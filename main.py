@@ -1,32 +1,328 @@
 from fastapi import FastAPI, Request, Depends, HTTPException, Form, UploadFile, File
-from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 import jinja2
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey, Text, Boolean, Float
+from sqlalchemy import create_engine, event, inspect, select, update, delete, case, exists, func, or_, false, true, Column, Index, Integer, String, DateTime, ForeignKey, Text, Boolean, Float
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session, relationship
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.orm import sessionmaker, Session, relationship, aliased, selectinload, load_only
 from sqlalchemy.exc import IntegrityError
-from datetime import datetime
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.engine import Engine, make_url
+from datetime import datetime, timedelta
+from contextvars import ContextVar
+from collections import OrderedDict
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 from passlib.context import CryptContext
 import os
+import json
 import shutil
-import smtplib
+import time
+import math
+import re
+import asyncio
+import hmac
+import threading
+import hashlib
+import secrets
+import aiosmtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from email.mime.image import MIMEImage
 from email import encoders
 from pathlib import Path
+from urllib.parse import quote
+
+# Environment config (supports .env file without extra deps)
+def load_env_file(path: str = ".env"):
+    env_path = Path(path)
+    if not env_path.exists():
+        return
+    for line in env_path.read_text(encoding="utf-8").splitlines():
+        line = line.strip()
+        if not line or line.startswith("#") or "=" not in line:
+            continue
+        key, val = line.split("=", 1)
+        os.environ.setdefault(key.strip(), val.strip())
+
+load_env_file()
+
+def env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value not in (None, "") else default
+
+def env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value in (None, ""):
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
 
 # Database Setup
-SQLALCHEMY_DATABASE_URL = "sqlite:///./apmes.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL") or "sqlite:///./apmes.db"
+if SQLALCHEMY_DATABASE_URL.startswith("postgres://"):
+    # Heroku still hands out the legacy scheme, which SQLAlchemy no longer accepts
+    SQLALCHEMY_DATABASE_URL = SQLALCHEMY_DATABASE_URL.replace("postgres://", "postgresql://", 1)
+IS_SQLITE = SQLALCHEMY_DATABASE_URL.startswith("sqlite")
+
+# Connection pool sizing. Every gunicorn worker owns a sync and an async engine, so the
+# server-side connection budget (DB_MAX_CONNECTIONS) is split across 2 * WEB_CONCURRENCY pools.
+WEB_CONCURRENCY = env_int("WEB_CONCURRENCY", 4)
+if IS_SQLITE:
+    DB_POOL_SIZE = env_int("DB_POOL_SIZE", 5)
+    DB_MAX_OVERFLOW = env_int("DB_MAX_OVERFLOW", 10)
+    DB_POOL_RECYCLE = env_int("DB_POOL_RECYCLE", -1)
+    DB_POOL_PRE_PING = env_bool("DB_POOL_PRE_PING", False)
+else:
+    DB_MAX_CONNECTIONS = env_int("DB_MAX_CONNECTIONS", 20)
+    DB_POOL_SIZE = env_int("DB_POOL_SIZE", max(1, DB_MAX_CONNECTIONS // (2 * WEB_CONCURRENCY)))
+    DB_MAX_OVERFLOW = env_int("DB_MAX_OVERFLOW", 0)
+    DB_POOL_RECYCLE = env_int("DB_POOL_RECYCLE", 1800)
+    DB_POOL_PRE_PING = env_bool("DB_POOL_PRE_PING", True)
+DB_POOL_TIMEOUT = env_int("DB_POOL_TIMEOUT", 30)
+# Server-side statement timeout in milliseconds (PostgreSQL only, 0 disables it)
+DB_STATEMENT_TIMEOUT_MS = env_int("DB_STATEMENT_TIMEOUT_MS", 0 if IS_SQLITE else 30000)
+
+def database_engine_options(async_driver: bool = False) -> dict:
+    """Build create_engine / create_async_engine keyword arguments for the configured backend"""
+    options = {}
+    if IS_SQLITE:
+        if not async_driver:
+            options["connect_args"] = {"check_same_thread": False}
+        if ":memory:" in SQLALCHEMY_DATABASE_URL or SQLALCHEMY_DATABASE_URL.rstrip("/") == "sqlite:":
+            # In-memory databases use a single static connection, pool tuning does not apply
+            return options
+    elif DB_STATEMENT_TIMEOUT_MS:
+        if async_driver:
+            options["connect_args"] = {"server_settings": {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}}
+        else:
+            options["connect_args"] = {"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+    options.update(
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        pool_timeout=DB_POOL_TIMEOUT,
+    )
+    return options
+
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **database_engine_options())
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+def to_async_database_url(url: str) -> str:
+    """Map a sync database URL onto its asyncio driver (aiosqlite / asyncpg)"""
+    if url.startswith("sqlite:"):
+        return url.replace("sqlite:", "sqlite+aiosqlite:", 1)
+    if url.startswith("postgres://"):
+        return url.replace("postgres://", "postgresql+asyncpg://", 1)
+    if url.startswith("postgresql://") or url.startswith("postgresql+psycopg2://"):
+        return "postgresql+asyncpg://" + url.split("://", 1)[1]
+    return url
+
+# Async engine for the hot request paths, so a slow query no longer stalls the event loop.
+# expire_on_commit=False keeps loaded rows usable by the templates after commit.
+async_engine = create_async_engine(to_async_database_url(SQLALCHEMY_DATABASE_URL), **database_engine_options(async_driver=True))
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False, autoflush=False)
+
+# SQLite pragma profiles, applied to every new connection of both engines. "performance"
+# lets readers proceed while a writer holds the WAL and makes writers wait instead of
+# failing with "database is locked"; "safe" keeps the rollback journal with full fsync.
+SQLITE_PRAGMA_PROFILES = {
+    "performance": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "cache_size": -20000,  # negative = KiB, i.e. ~20 MB page cache per connection
+        "mmap_size": 134217728,
+        "temp_store": "MEMORY",
+        "foreign_keys": "ON",
+    },
+    "safe": {
+        "journal_mode": "DELETE",
+        "synchronous": "FULL",
+        "busy_timeout": 5000,
+        "foreign_keys": "ON",
+    },
+    "none": {},
+}
+SQLITE_PRAGMA_PROFILE = (os.getenv("SQLITE_PRAGMA_PROFILE") or "performance").lower()
+if SQLITE_PRAGMA_PROFILE not in SQLITE_PRAGMA_PROFILES:
+    raise ValueError(f"Unknown SQLITE_PRAGMA_PROFILE {SQLITE_PRAGMA_PROFILE!r}, expected one of {sorted(SQLITE_PRAGMA_PROFILES)}")
+SQLITE_PRAGMAS = dict(SQLITE_PRAGMA_PROFILES[SQLITE_PRAGMA_PROFILE])
+# Individual pragmas can still be overridden, e.g. SQLITE_BUSY_TIMEOUT=10000
+for _pragma in ("journal_mode", "synchronous", "busy_timeout", "cache_size", "mmap_size", "temp_store", "foreign_keys"):
+    _override = os.getenv(f"SQLITE_{_pragma.upper()}")
+    if _override:
+        SQLITE_PRAGMAS[_pragma] = _override
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+if IS_SQLITE:
+    event.listen(engine, "connect", apply_sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", apply_sqlite_pragmas)
+
+# Read path for GET routes. DATABASE_READ_URL can point at a PostgreSQL read replica;
+# without one, PostgreSQL reads share the primary pool in READ ONLY transactions and SQLite
+# reads get their own connections with query_only=ON. Read sessions never flush or commit.
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL") or ""
+if DATABASE_READ_URL.startswith("postgres://"):
+    DATABASE_READ_URL = DATABASE_READ_URL.replace("postgres://", "postgresql://", 1)
+
+def apply_sqlite_query_only(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("PRAGMA query_only=ON")
+    finally:
+        cursor.close()
+
+if DATABASE_READ_URL:
+    read_async_engine = create_async_engine(to_async_database_url(DATABASE_READ_URL), **database_engine_options(async_driver=True))
+elif IS_SQLITE:
+    read_async_engine = create_async_engine(to_async_database_url(SQLALCHEMY_DATABASE_URL), **database_engine_options(async_driver=True))
+    event.listen(read_async_engine.sync_engine, "connect", apply_sqlite_pragmas)
+    event.listen(read_async_engine.sync_engine, "connect", apply_sqlite_query_only)
+else:
+    read_async_engine = async_engine
+if read_async_engine.dialect.name == "postgresql":
+    read_async_engine = read_async_engine.execution_options(postgresql_readonly=True)
+ReadSessionLocal = async_sessionmaker(read_async_engine, expire_on_commit=False, autoflush=False)
+
+def report_database_profile():
+    """Print the backend, pool and (for SQLite) the pragma values actually in effect"""
+    print("DATABASE CONFIGURATION:")
+    print(f"  - backend: {engine.dialect.name} ({engine.url.render_as_string(hide_password=True)})")
+    if IS_SQLITE:
+        print(f"  - pragma profile: {SQLITE_PRAGMA_PROFILE}")
+        with engine.connect() as conn:
+            for name in SQLITE_PRAGMAS:
+                value = conn.exec_driver_sql(f"PRAGMA {name}").scalar()
+                print(f"  - {name} = {value}")
+    else:
+        print(f"  - pool: size={DB_POOL_SIZE} overflow={DB_MAX_OVERFLOW} recycle={DB_POOL_RECYCLE}s pre_ping={DB_POOL_PRE_PING}")
+        print(f"  - statement_timeout = {DB_STATEMENT_TIMEOUT_MS} ms")
+    if DATABASE_READ_URL:
+        print(f"  - reads: replica ({make_url(DATABASE_READ_URL).render_as_string(hide_password=True)})")
+    else:
+        print(f"  - reads: primary ({'query_only connections' if IS_SQLITE else 'read-only transactions'})")
+    print()
+
+# SQL instrumentation
+# Every statement on any engine is timed; the totals for the current request are kept in
+# request_sql_stats (set by the instrument_request middleware). Statements slower than
+# SLOW_QUERY_MS are logged together with their query plan.
+SLOW_QUERY_MS = env_int("SLOW_QUERY_MS", 200)
+request_sql_stats = ContextVar("request_sql_stats", default=None)
+
+def new_sql_stats():
+    return {"count": 0, "total_ms": 0.0, "slowest_ms": 0.0, "slowest_sql": None}
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+@event.listens_for(Engine, "handle_error")
+def discard_query_timer(exception_context):
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("query_start_time"):
+        conn.info["query_start_time"].pop()
+
+@event.listens_for(Engine, "after_cursor_execute")
+def record_query_time(conn, cursor, statement, parameters, context, executemany):
+    elapsed_ms = (time.perf_counter() - conn.info["query_start_time"].pop()) * 1000
+    if conn.info.get("explaining"):
+        return
+    stats = request_sql_stats.get()
+    if stats is not None:
+        stats["count"] += 1
+        stats["total_ms"] += elapsed_ms
+        if elapsed_ms > stats["slowest_ms"]:
+            stats["slowest_ms"] = elapsed_ms
+            stats["slowest_sql"] = statement
+    if SLOW_QUERY_MS and elapsed_ms >= SLOW_QUERY_MS:
+        log_slow_query(conn, statement, parameters, elapsed_ms, executemany)
+
+def log_slow_query(conn, statement, parameters, elapsed_ms, executemany=False):
+    print(f"SLOW QUERY: {elapsed_ms:.1f} ms: {' '.join(statement.split())}")
+    if executemany or not statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+        return
+    explain = "EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite" else "EXPLAIN "
+    conn.info["explaining"] = True
+    try:
+        for row in conn.exec_driver_sql(explain + statement, parameters).all():
+            print(f"  PLAN: {' | '.join(str(col) for col in row)}")
+    except Exception as e:
+        print(f"  PLAN unavailable: {e}")
+    finally:
+        conn.info["explaining"] = False
+
 # Password hashing
-pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
+# New hashes use argon2id; pbkdf2_sha256 is only kept to verify existing hashes. Hashing is
+# deliberately CPU-expensive, so it runs in a small thread pool (argon2-cffi and hashlib both
+# release the GIL) instead of on the event loop. Any hash that does not match the current
+# scheme and cost parameters is re-hashed on the next successful login.
+# Use `python main.py calibrate-hash` to pick ARGON2_* values for the target machine.
+ARGON2_TIME_COST = env_int("ARGON2_TIME_COST", 2)
+ARGON2_MEMORY_COST = env_int("ARGON2_MEMORY_COST", 19456)  # KiB
+ARGON2_PARALLELISM = env_int("ARGON2_PARALLELISM", 1)
+PASSWORD_PBKDF2_ROUNDS = env_int("PASSWORD_PBKDF2_ROUNDS", 29000)
+PASSWORD_HASH_CONCURRENCY = env_int("PASSWORD_HASH_CONCURRENCY", 2)
+pwd_context = CryptContext(
+    schemes=["argon2", "pbkdf2_sha256"],
+    deprecated="auto",
+    argon2__type="ID",
+    argon2__time_cost=ARGON2_TIME_COST,
+    argon2__memory_cost=ARGON2_MEMORY_COST,
+    argon2__parallelism=ARGON2_PARALLELISM,
+    pbkdf2_sha256__default_rounds=PASSWORD_PBKDF2_ROUNDS,
+)
+password_hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_CONCURRENCY, thread_name_prefix="password-hash")
+
+async def hash_password(password: str) -> str:
+    return await asyncio.get_running_loop().run_in_executor(password_hash_executor, pwd_context.hash, password)
+
+async def verify_password(password: str, hashed_password: str):
+    """Return (valid, new_hash); new_hash is set when the stored hash should be upgraded"""
+    if not hashed_password:
+        return False, None
+    return await asyncio.get_running_loop().run_in_executor(
+        password_hash_executor, pwd_context.verify_and_update, password, hashed_password
+    )
+
+def measure_argon2_verify_ms(time_cost: int, memory_cost: int, parallelism: int, samples: int = 5) -> float:
+    """Median verify latency in milliseconds for the given argon2id parameters on this machine"""
+    hasher = pwd_context.handler("argon2").using(type="ID", time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism)
+    hashed = hasher.hash("calibration-password")
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        hasher.verify("calibration-password", hashed)
+        timings.append((time.perf_counter() - start) * 1000)
+    return sorted(timings)[len(timings) // 2]
+
+def calibrate_argon2(target_ms: float, memory_cost: int = ARGON2_MEMORY_COST, parallelism: int = ARGON2_PARALLELISM):
+    """Pick argon2id time/memory costs whose verify latency is as close as possible to target_ms"""
+    # Prefer spending the budget on memory (what makes argon2 expensive on GPUs): keep the
+    # configured memory cost and raise the passes, only shrinking memory when a single pass
+    # is already over budget. 8 MiB is the floor below which argon2 loses most of its value.
+    while memory_cost > 8192 and measure_argon2_verify_ms(1, memory_cost, parallelism) > target_ms:
+        memory_cost = max(8192, memory_cost // 2)
+    time_cost = 1
+    elapsed = measure_argon2_verify_ms(time_cost, memory_cost, parallelism)
+    while True:
+        candidate = measure_argon2_verify_ms(time_cost + 1, memory_cost, parallelism)
+        if abs(candidate - target_ms) >= abs(elapsed - target_ms):
+            break
+        time_cost, elapsed = time_cost + 1, candidate
+    return time_cost, memory_cost, parallelism, elapsed
 
 
 # Models
@@ -50,10 +346,16 @@ class User(Base):
     approval_status = Column(String, default="approved")  # approved | pending | rejected
     approval_by_id = Column(Integer, ForeignKey("users.id"))
     approval_decision_at = Column(DateTime)
+    registration_notified_at = Column(DateTime)  # when professors were told about this registration
     created_at = Column(DateTime, default=datetime.utcnow)
 
     approver = relationship("User", remote_side=[id], foreign_keys=[approval_by_id])
 
+    __table_args__ = (
+        # Dashboard student lists: filter on role + status, ordered by decision date
+        Index("ix_users_role_status_decision", "role", "approval_status", "approval_decision_at"),
+    )
+
 class Project(Base):
     __tablename__ = "projects"
     id = Column(Integer, primary_key=True, index=True)
@@ -61,11 +363,13 @@ class Project(Base):
     type = Column(String)
     mission_objective = Column(Text)
     success_criteria = Column(Text)
-    manager_id = Column(Integer, ForeignKey("users.id"))
+    manager_id = Column(Integer, ForeignKey("users.id"), index=True)
     start_date = Column(DateTime)
     end_date = Column(DateTime)
     status = Column(String, default="Active")
     overall_progress = Column(Integer, default=0)  # 0-100%
+    # Internal projects (the general "Membres d'équipe" roster) that are hidden from project lists
+    is_system = Column(Boolean, nullable=False, default=False, server_default=false())
     created_at = Column(DateTime, default=datetime.utcnow)
     
     phases = relationship("Phase", back_populates="project", cascade="all, delete-orphan")
@@ -74,10 +378,17 @@ class Project(Base):
     files = relationship("ProjectFile", back_populates="project", cascade="all, delete-orphan")
     messages = relationship("Message", back_populates="project", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        # At most one system project; the partial index only holds that single row
+        Index("uq_projects_system", "is_system", unique=True, sqlite_where=is_system == true(), postgresql_where=is_system == true()),
+    )
+
+TEAM_MEMBERS_PROJECT_NAME = "Membres d'équipe"
+
 class Phase(Base):
     __tablename__ = "phases"
     id = Column(Integer, primary_key=True, index=True)
-    project_id = Column(Integer, ForeignKey("projects.id"))
+    project_id = Column(Integer, ForeignKey("projects.id"), index=True)
     name = Column(String)
     status = Column(String, default="Not Started")
     responsible = Column(String)
@@ -90,7 +401,7 @@ class Phase(Base):
 class Risk(Base):
     __tablename__ = "risks"
     id = Column(Integer, primary_key=True, index=True)
-    project_id = Column(Integer, ForeignKey("projects.id"))
+    project_id = Column(Integer, ForeignKey("projects.id"), index=True)
     description = Column(Text)
     probability = Column(String)
     severity = Column(String)
@@ -103,7 +414,7 @@ class TeamMember(Base):
     __tablename__ = "team_members"
     id = Column(Integer, primary_key=True, index=True)
     project_id = Column(Integer, ForeignKey("projects.id"))
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
     role = Column(String)
     responsibilities = Column(Text)
     progress = Column(Integer, default=0)  # 0, 25, 50, 75, 100
@@ -112,6 +423,11 @@ class TeamMember(Base):
     project = relationship("Project", back_populates="team_members")
     user = relationship("User")
 
+    __table_args__ = (
+        # One membership per user and project; also serves every lookup by project_id
+        Index("uq_team_members_project_user", "project_id", "user_id", unique=True),
+    )
+
 class ProjectFile(Base):
     __tablename__ = "project_files"
     id = Column(Integer, primary_key=True, index=True)
@@ -127,6 +443,10 @@ class ProjectFile(Base):
     project = relationship("Project", back_populates="files")
     uploader = relationship("User")
 
+    __table_args__ = (
+        Index("ix_project_files_project_uploaded", "project_id", "uploaded_at"),
+    )
+
 class Message(Base):
     __tablename__ = "messages"
     id = Column(Integer, primary_key=True, index=True)
@@ -138,40 +458,273 @@ class Message(Base):
     project = relationship("Project", back_populates="messages")
     user = relationship("User")
 
-# Create tables
-Base.metadata.create_all(bind=engine)
-
-# Ensure new user columns exist when running against an old database
-def ensure_user_columns():
-    with engine.begin() as conn:
-        existing_cols = {row[1] for row in conn.exec_driver_sql("PRAGMA table_info(users)").all()}
-        columns_to_add = [
-            ("first_name", "TEXT"),
-            ("last_name", "TEXT"),
-            ("phone_number", "TEXT"),
-            ("gender", "TEXT"),
-            ("student_id_number", "TEXT"),
-            ("birth_place", "TEXT"),
-            ("birth_date", "DATETIME"),
-            ("student_card_image", "TEXT"),
-            ("specialty", "TEXT"),
-            ("profile_image", "TEXT"),
-            ("approval_status", "TEXT"),
-            ("approval_by_id", "INTEGER"),
-            ("approval_decision_at", "DATETIME"),
-        ]
-        for col_name, ddl in columns_to_add:
-            if col_name not in existing_cols:
-                conn.exec_driver_sql(f"ALTER TABLE users ADD COLUMN {col_name} {ddl}")
-        # Backfill approval_status as approved for existing records
-        if "approval_status" not in existing_cols:
-            conn.exec_driver_sql("UPDATE users SET approval_status = 'approved' WHERE approval_status IS NULL")
+    __table_args__ = (
+        Index("ix_messages_project_created", "project_id", "created_at"),
+    )
+
+class UserSession(Base):
+    __tablename__ = "sessions"
+    id = Column(String, primary_key=True)  # SHA-256 of the session id carried by the cookie
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+class RateLimitBucket(Base):
+    __tablename__ = "rate_limit_buckets"
+    key = Column(String, primary_key=True)  # "<route>:<ip|account>:<value>"
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False)  # epoch seconds of the last refill
+    expires_at = Column(Float, nullable=False, index=True)  # bucket is full again after this
+
+class VerificationCode(Base):
+    __tablename__ = "verification_codes"
+    email = Column(String, primary_key=True)  # one pending code per address, resending replaces it
+    code_hash = Column(String, nullable=False)  # HMAC-SHA256 of the code, keyed with SECRET_KEY
+    attempts = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+class EmailOutbox(Base):
+    __tablename__ = "email_outbox"
+    id = Column(Integer, primary_key=True)
+    recipients = Column(Text, nullable=False)  # JSON list of addresses
+    recipient_count = Column(Integer, nullable=False, default=1, server_default="1")
+    subject = Column(String, nullable=False)
+    body = Column(Text, nullable=False)
+    attachments = Column(Text, nullable=False, default="[]")  # JSON list of file paths
+    email_type = Column(String, default="general")
+    priority = Column(Integer, nullable=False, default=1, server_default="1")  # see EMAIL_PRIORITY_*
+    status = Column(String, nullable=False, default="pending")  # pending, sending, sent, dead
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    claim_token = Column(String)
+    last_error = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime)
+
+    __table_args__ = (
+        Index("ix_email_outbox_status_next_attempt", "status", "next_attempt_at"),
+        Index("ix_email_outbox_status_sent", "status", "sent_at"),
+    )
+
+class EmailSendingPause(Base):
+    __tablename__ = "email_sending_pause"
+    id = Column(Integer, primary_key=True)  # single row, see EMAIL_SENDING_PAUSE_ID
+    paused_until = Column(DateTime)
+    reason = Column(Text)  # the provider reply that triggered the pause
+
+class NotificationDigest(Base):
+    __tablename__ = "notification_digests"
+    name = Column(String, primary_key=True)  # one row per digest kind, e.g. "professor_registrations"
+    sent_at = Column(DateTime)
+
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+    version = Column(Integer, primary_key=True)
+    name = Column(String)
+    applied_at = Column(DateTime, default=datetime.utcnow)
+
+# Schema migrations
+# Each migration runs once, in order, and is recorded in schema_version. Run them with
+# `python main.py migrate` (the Heroku release phase does this before workers start);
+# workers only compare the recorded version with SCHEMA_HEAD at startup.
+def add_missing_columns(conn, model, column_names):
+    existing_cols = {col["name"] for col in inspect(conn).get_columns(model.__tablename__)}
+    added = []
+    for col_name in column_names:
+        if col_name not in existing_cols:
+            # CreateColumn renders type, NOT NULL and server default for the target dialect
+            ddl = CreateColumn(model.__table__.c[col_name]).compile(dialect=conn.dialect)
+            conn.exec_driver_sql(f"ALTER TABLE {model.__tablename__} ADD COLUMN {ddl}")
+            added.append(col_name)
+    return added
+
+def create_model_indexes(conn, index_names):
+    indexes = {index.name: index for table in Base.metadata.sorted_tables for index in table.indexes}
+    for name in index_names:
+        indexes[name].create(conn, checkfirst=True)
+
+def migration_0001_user_columns(conn):
+    """Profile and approval columns added to users after the first release"""
+    added = add_missing_columns(conn, User, [
+        "first_name", "last_name", "phone_number", "gender", "student_id_number",
+        "birth_place", "birth_date", "student_card_image", "specialty", "profile_image",
+        "approval_status", "approval_by_id", "approval_decision_at",
+    ])
+    # Backfill approval_status as approved for existing records
+    if "approval_status" in added:
+        conn.exec_driver_sql("UPDATE users SET approval_status = 'approved' WHERE approval_status IS NULL")
+
+def migration_0002_hot_route_indexes(conn):
+    """Indexes for the foreign keys and filters used by the dashboard and project pages"""
+    # The unique membership index cannot be built while duplicate rows exist
+    conn.exec_driver_sql(
+        "DELETE FROM team_members WHERE id NOT IN "
+        "(SELECT MIN(id) FROM team_members GROUP BY project_id, user_id)"
+    )
+    create_model_indexes(conn, [
+        "ix_users_role_status_decision",
+        "ix_projects_manager_id",
+        "ix_phases_project_id",
+        "ix_risks_project_id",
+        "ix_team_members_user_id",
+        "uq_team_members_project_user",
+        "ix_project_files_project_uploaded",
+        "ix_messages_project_created",
+    ])
+
+def migration_0003_system_project_flag(conn):
+    """Flag the general team members project instead of matching it by name"""
+    add_missing_columns(conn, Project, ["is_system"])
+    conn.execute(
+        Project.__table__.update()
+        .where(Project.id == select(func.min(Project.id)).where(Project.name == TEAM_MEMBERS_PROJECT_NAME).scalar_subquery())
+        .values(is_system=True)
+    )
+    create_model_indexes(conn, ["uq_projects_system"])
+
+def migration_0004_sessions(conn):
+    """Server-side login sessions shared by all workers"""
+    UserSession.__table__.create(conn, checkfirst=True)
+
+def migration_0005_rate_limit_buckets(conn):
+    """Token buckets shared by all workers for the rate-limited routes"""
+    RateLimitBucket.__table__.create(conn, checkfirst=True)
+
+def migration_0006_verification_codes(conn):
+    """Professor verification codes shared by all workers"""
+    VerificationCode.__table__.create(conn, checkfirst=True)
+
+def migration_0007_email_outbox(conn):
+    """Outgoing email queue drained by the background sender"""
+    EmailOutbox.__table__.create(conn, checkfirst=True)
+
+def migration_0008_email_priority(conn):
+    """Priority classes for the outbox, so verification codes are sent first"""
+    add_missing_columns(conn, EmailOutbox, ["priority"])
+
+def migration_0009_email_quota(conn):
+    """Recipient counts and a sent_at index for the sending governor's quota usage"""
+    if "recipient_count" in add_missing_columns(conn, EmailOutbox, ["recipient_count"]):
+        table = EmailOutbox.__table__
+        for row in conn.execute(select(table.c.id, table.c.recipients)).all():
+            conn.execute(table.update().where(table.c.id == row.id).values(recipient_count=len(json.loads(row.recipients))))
+    create_model_indexes(conn, ["ix_email_outbox_status_sent"])
+
+def migration_0010_notification_digests(conn):
+    """Professor registration digest: per-student notified flag and the send time shared by all workers"""
+    NotificationDigest.__table__.create(conn, checkfirst=True)
+    if "registration_notified_at" in add_missing_columns(conn, User, ["registration_notified_at"]):
+        # Professors were emailed on every registration until now, so nobody is waiting for a digest
+        users = User.__table__
+        conn.execute(
+            users.update().where(users.c.role == "Student")
+            .values(registration_notified_at=func.coalesce(users.c.created_at, datetime.utcnow()))
+        )
 
-ensure_user_columns()
+def migration_0011_email_sending_pause(conn):
+    """Provider quota pause shared by all workers"""
+    EmailSendingPause.__table__.create(conn, checkfirst=True)
+
+MIGRATIONS = [
+    (1, "user profile and approval columns", migration_0001_user_columns),
+    (2, "hot route indexes", migration_0002_hot_route_indexes),
+    (3, "system project flag", migration_0003_system_project_flag),
+    (4, "sessions table", migration_0004_sessions),
+    (5, "rate limit buckets", migration_0005_rate_limit_buckets),
+    (6, "verification codes", migration_0006_verification_codes),
+    (7, "email outbox", migration_0007_email_outbox),
+    (8, "email outbox priority", migration_0008_email_priority),
+    (9, "email quota tracking", migration_0009_email_quota),
+    (10, "notification digests", migration_0010_notification_digests),
+    (11, "email sending pause", migration_0011_email_sending_pause),
+]
+SCHEMA_HEAD = MIGRATIONS[-1][0]
+
+def get_schema_version(conn):
+    """Return the applied schema version, or None when the database has never been migrated"""
+    if not inspect(conn).has_table(SchemaVersion.__tablename__):
+        return None
+    return conn.execute(select(func.max(SchemaVersion.version))).scalar() or 0
+
+def lock_for_migration(conn):
+    """Serialize concurrent migrate() calls (e.g. several workers booting on an empty database)"""
+    if conn.dialect.name == "sqlite":
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+    elif conn.dialect.name == "postgresql":
+        conn.exec_driver_sql("SELECT pg_advisory_xact_lock(47110001)")
+
+def migrate():
+    """Bring the database schema up to SCHEMA_HEAD; returns the list of applied versions"""
+    applied = []
+    with engine.connect() as conn:
+        lock_for_migration(conn)
+        version = get_schema_version(conn)
+        if version is None and not inspect(conn).has_table(User.__tablename__):
+            # Empty database: build the current schema directly and record it as up to date
+            Base.metadata.create_all(conn)
+            for number, name, _ in MIGRATIONS:
+                conn.execute(SchemaVersion.__table__.insert().values(version=number, name=name, applied_at=datetime.utcnow()))
+            applied = [number for number, _, _ in MIGRATIONS]
+        else:
+            # Database from before versioned migrations: tables that are missing entirely are
+            # created with their current definition, the rest is upgraded step by step
+            Base.metadata.create_all(conn)
+            version = version or 0
+            for number, name, upgrade in MIGRATIONS:
+                if number <= version:
+                    continue
+                print(f"MIGRATION: applying {number:04d} {name}")
+                upgrade(conn)
+                conn.execute(SchemaVersion.__table__.insert().values(version=number, name=name, applied_at=datetime.utcnow()))
+                applied.append(number)
+        conn.commit()
+    return applied
+
+def check_schema_version():
+    """Cheap startup check: a single SELECT when the schema is already at head"""
+    with engine.connect() as conn:
+        version = get_schema_version(conn)
+    if version == SCHEMA_HEAD:
+        return
+    if not env_bool("DB_AUTO_MIGRATE", True):
+        raise RuntimeError(
+            f"Database schema is at version {version}, expected {SCHEMA_HEAD}. Run `python main.py migrate`."
+        )
+    migrate()
 
 # FastAPI App
 app = FastAPI(title="INTERSTELLAR CLUB")
 
+@app.on_event("startup")
+def verify_database_schema():
+    # Reported here rather than at import, so importing main (tests, CLI commands) does not
+    # open the database
+    report_database_profile()
+    check_schema_version()
+
+@app.middleware("http")
+async def instrument_request(request: Request, call_next):
+    """Expose per-request DB query count/time as Server-Timing and write an access log line"""
+    stats = new_sql_stats()
+    token = request_sql_stats.set(stats)
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        request_sql_stats.reset(token)
+    total_ms = (time.perf_counter() - started) * 1000
+    response.headers["Server-Timing"] = (
+        f'db;dur={stats["total_ms"]:.1f};desc="{stats["count"]} queries", app;dur={total_ms:.1f}'
+    )
+    slowest = " ".join(stats["slowest_sql"].split())[:120] if stats["slowest_sql"] else ""
+    print(
+        f'ACCESS: method={request.method} path={request.url.path} status={response.status_code} '
+        f'duration_ms={total_ms:.1f} db_queries={stats["count"]} db_ms={stats["total_ms"]:.1f} '
+        f'db_slowest_ms={stats["slowest_ms"]:.1f} db_slowest="{slowest}"'
+    )
+    return response
+
 # Create necessary directories
 os.makedirs("templates", exist_ok=True)
 os.makedirs("static/css", exist_ok=True)
@@ -189,20 +742,6 @@ templates.env = jinja2_env
 app.mount("/static", StaticFiles(directory="static"), name="static")
 app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
 
-# Email config (supports .env file without extra deps)
-def load_env_file(path: str = ".env"):
-    env_path = Path(path)
-    if not env_path.exists():
-        return
-    for line in env_path.read_text(encoding="utf-8").splitlines():
-        line = line.strip()
-        if not line or line.startswith("#") or "=" not in line:
-            continue
-        key, val = line.split("=", 1)
-        os.environ.setdefault(key.strip(), val.strip())
-
-load_env_file()
-
 # Email configuration
 EMAIL_HOST = os.getenv("EMAIL_HOST") or "smtp.gmail.com"
 EMAIL_PORT = int(os.getenv("EMAIL_PORT", "587"))
@@ -253,259 +792,199 @@ check_email_configuration()
 # server = smtplib.SMTP_SSL(EMAIL_HOST, EMAIL_PORT)
 # server.login(EMAIL_USER, EMAIL_PASS)
 
+# SMTP connection pool
+# Delivery uses aiosmtplib, so a worker keeps several messages in flight on the event loop
+# without threads. Authenticated connections are kept open between messages (at most
+# EMAIL_SMTP_POOL_SIZE per worker, which also bounds concurrent deliveries) and reused while
+# they answer NOOP, so a burst of emails costs one TLS handshake and login instead of one per
+# message. Connections idle for more than EMAIL_SMTP_IDLE_TIMEOUT seconds or that already
+# sent EMAIL_SMTP_MAX_MESSAGES messages are replaced.
+EMAIL_SMTP_POOL_SIZE = env_int("EMAIL_SMTP_POOL_SIZE", 4)
+EMAIL_SMTP_IDLE_TIMEOUT = env_int("EMAIL_SMTP_IDLE_TIMEOUT", 60)
+EMAIL_SMTP_MAX_MESSAGES = env_int("EMAIL_SMTP_MAX_MESSAGES", 100)
+
+async def close_smtp_connection(server):
+    try:
+        await server.quit()
+    except Exception:
+        server.close()
+
+async def open_smtp_connection():
+    """Connect and log in: STARTTLS on port 587 first, then SSL on port 465 if that fails"""
+    print("EMAIL: Connecting to SMTP server...")
+    if EMAIL_PORT == 587:
+        server = aiosmtplib.SMTP(hostname=EMAIL_HOST, port=EMAIL_PORT, timeout=10, start_tls=False)
+        try:
+            await server.connect()
+            print("EMAIL: Starting TLS...")
+            await server.starttls()
+            print("EMAIL: Logging in...")
+            await server.login(EMAIL_USER, EMAIL_PASS)
+            return server
+        except Exception as tls_error:
+            print(f"EMAIL: TLS failed, trying SSL: {tls_error}")
+            server.close()
+    try:
+        print("EMAIL: Trying SSL connection...")
+        server = aiosmtplib.SMTP(hostname=EMAIL_HOST, port=465, timeout=10, use_tls=True)
+        await server.connect()
+        print("EMAIL: Logging in...")
+        await server.login(EMAIL_USER, EMAIL_PASS)
+        return server
+    except Exception as ssl_error:
+        print(f"EMAIL: SSL also failed: {ssl_error}")
+        raise
+
+class SMTPConnectionPool:
+    """Pool of logged-in aiosmtplib connections; each connection serves one message at a time"""
+
+    def __init__(self, size, idle_timeout, max_messages):
+        self.size = size
+        self.slots = None  # asyncio.Semaphore, created on first use inside the running loop
+        self.idle = []  # (server, last used monotonic time, messages sent)
+        self.idle_timeout = idle_timeout
+        self.max_messages = max_messages
+
+    async def acquire(self):
+        """Return (server, messages sent) with a healthy connection, opening one if needed"""
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.size)
+        await self.slots.acquire()
+        try:
+            while self.idle:
+                server, last_used, sent = self.idle.pop()
+                if time.monotonic() - last_used < self.idle_timeout and sent < self.max_messages:
+                    try:
+                        if (await server.noop()).code == 250:
+                            return server, sent
+                    except (aiosmtplib.SMTPException, OSError):
+                        pass
+                await close_smtp_connection(server)
+            return await open_smtp_connection(), 0
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, server, sent):
+        self.idle.append((server, time.monotonic(), sent))
+        self.slots.release()
+
+    def discard(self, server):
+        server.close()
+        self.slots.release()
+
+    async def send(self, from_addr, recipients, message):
+        for attempt in range(2):
+            server, sent = await self.acquire()
+            try:
+                await server.sendmail(from_addr, recipients, message)
+            except aiosmtplib.SMTPServerDisconnected:
+                # Dropped by the server between NOOP and send: retry once on a new connection
+                self.discard(server)
+                if attempt:
+                    raise
+                continue
+            except (aiosmtplib.SMTPRecipientsRefused, aiosmtplib.SMTPSenderRefused, aiosmtplib.SMTPDataError):
+                # The message was refused but the session is still usable
+                self.release(server, sent + 1)
+                raise
+            except BaseException:
+                self.discard(server)
+                raise
+            self.release(server, sent + 1)
+            return
+
+    async def close_all(self):
+        idle, self.idle = self.idle, []
+        for server, _, _ in idle:
+            await close_smtp_connection(server)
+        # The next use may come from another event loop (e.g. a new TestClient). Callers stop
+        # every sender first, so no slot is held when the semaphore is dropped
+        self.slots = None
+
+smtp_pool = SMTPConnectionPool(EMAIL_SMTP_POOL_SIZE, EMAIL_SMTP_IDLE_TIMEOUT, EMAIL_SMTP_MAX_MESSAGES)
+
+# Inline email assets
+# The logos embedded in every email are read and base64-encoded into MIME parts once, then the
+# same parts are attached to each message (they are never modified after creation). A file
+# whose mtime changed is re-read on the next send.
+class InlineAssetRegistry:
+    def __init__(self, assets):
+        self.assets = assets  # [(path, Content-ID)]
+        self.lock = threading.Lock()
+        self.loaded = {}  # path -> (mtime_ns, MIMEImage)
+
+    def load(self, path, cid):
+        with open(path, "rb") as f:
+            part = MIMEImage(f.read())
+        part.add_header('Content-ID', f'<{cid}>')
+        part.add_header('Content-Disposition', 'inline')
+        return part
+
+    def parts(self):
+        parts = []
+        for path, cid in self.assets:
+            try:
+                mtime = os.stat(path).st_mtime_ns
+                entry = self.loaded.get(path)
+                if entry is None or entry[0] != mtime:
+                    with self.lock:
+                        entry = (mtime, self.load(path, cid))
+                        self.loaded[path] = entry
+                parts.append(entry[1])
+            except FileNotFoundError:
+                continue
+            except Exception as e:
+                print(f"Logo attachment failed ({path}):", e)
+        return parts
+
+email_assets = InlineAssetRegistry([("static/logo.png", "logo_main"), ("static/logo1.png", "logo_secondary")])
+email_assets.parts()
+
+# Email templates
+# The HTML of outgoing emails lives in templates/emails and is compiled once at import; each
+# email_type maps to its theme through EMAIL_THEMES, so a send only substitutes variables.
+EMAIL_THEMES = {
+    "acceptance": {
+        "hero_gradient": "linear-gradient(135deg, #667eea 0%, #764ba2 50%, #f093fb 100%)",
+        "badge_text": "✨ Félicitations !",
+        "title_emoji": "🎉",
+    },
+    "rejection": {
+        "hero_gradient": "linear-gradient(135deg, #ff6b6b 0%, #ee5a52 50%, #f093fb 100%)",
+        "badge_text": "ℹ️ Information",
+        "title_emoji": "📋",
+    },
+    "verification": {
+        "hero_gradient": "linear-gradient(135deg, #4ecdc4 0%, #44a08d 50%, #096e5c 100%)",
+        "badge_text": "🔐 Vérification",
+        "title_emoji": "🔑",
+    },
+    "general": {
+        "hero_gradient": "linear-gradient(135deg, #667eea 0%, #764ba2 50%, #f093fb 100%)",
+        "badge_text": "📧 Message",
+        "title_emoji": "💫",
+    },
+}
+email_message_template = jinja2_env.get_template("emails/message.html")
+verification_code_email_template = jinja2_env.get_template("emails/verification_code.html")
+
 def create_beautiful_email_html(subject, body, email_type="general"):
-    """Create a beautiful HTML email template based on email type"""
-
-    # Determine styling based on email type
-    if "accept" in email_type.lower() or "approuv" in email_type.lower() or "félicitations" in email_type.lower():
-        hero_gradient = "linear-gradient(135deg, #667eea 0%, #764ba2 50%, #f093fb 100%)"
-        accent_color = "#667eea"
-        badge_text = "✨ Félicitations !"
-        title_emoji = "🎉"
-    elif "reject" in email_type.lower() or "refus" in email_type.lower():
-        hero_gradient = "linear-gradient(135deg, #ff6b6b 0%, #ee5a52 50%, #f093fb 100%)"
-        accent_color = "#ee5a52"
-        badge_text = "ℹ️ Information"
-        title_emoji = "📋"
-    elif "verification" in email_type.lower() or "code" in email_type.lower():
-        hero_gradient = "linear-gradient(135deg, #4ecdc4 0%, #44a08d 50%, #096e5c 100%)"
-        accent_color = "#4ecdc4"
-        badge_text = "🔐 Vérification"
-        title_emoji = "🔑"
-    else:
-        hero_gradient = "linear-gradient(135deg, #667eea 0%, #764ba2 50%, #f093fb 100%)"
-        accent_color = "#667eea"
-        badge_text = "📧 Message"
-        title_emoji = "💫"
-
-    beautiful_html = f"""
-    <!DOCTYPE html>
-    <html lang="fr">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>{title_emoji} INTERSTELLAR CLUB - {subject.replace('🎉', '').replace('📧', '').strip()}</title>
-        <style>
-            @import url('https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600;700;800&display=swap');
-
-            * {{
-                margin: 0;
-                padding: 0;
-                box-sizing: border-box;
-            }}
-
-            body {{
-                font-family: 'Inter', sans-serif;
-                background: linear-gradient(135deg, #f8fafc 0%, #e2e8f0 100%);
-                min-height: 100vh;
-                padding: 20px;
-            }}
-
-            .email-container {{
-                max-width: 650px;
-                margin: 0 auto;
-                background: #ffffff;
-                border-radius: 24px;
-                overflow: hidden;
-                box-shadow: 0 40px 80px rgba(0, 0, 0, 0.15);
-            }}
-
-            .hero-section {{
-                background: {hero_gradient};
-                padding: 60px 40px;
-                text-align: center;
-                position: relative;
-            }}
-
-            .hero-section::before {{
-                content: '';
-                position: absolute;
-                top: 0;
-                left: 0;
-                right: 0;
-                bottom: 0;
-                background: url('data:image/svg+xml,<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 100 100"><defs><pattern id="stars" x="0" y="0" width="20" height="20" patternUnits="userSpaceOnUse"><circle cx="10" cy="10" r="1" fill="rgba(255,255,255,0.1)"/><circle cx="5" cy="15" r="0.5" fill="rgba(255,255,255,0.1)"/></pattern></defs><rect width="100" height="100" fill="url(%23stars)"/></svg>');
-                opacity: 0.6;
-            }}
-
-            .hero-content {{
-                position: relative;
-                z-index: 2;
-            }}
-
-            .logo-section {{
-                margin-bottom: 30px;
-            }}
-
-            .club-title {{
-                font-size: 42px;
-                font-weight: 800;
-                color: #ffffff;
-                margin-bottom: 10px;
-                text-shadow: 0 4px 12px rgba(0, 0, 0, 0.3);
-                letter-spacing: -1px;
-            }}
-
-            .club-subtitle {{
-                font-size: 20px;
-                font-weight: 400;
-                color: rgba(255, 255, 255, 0.95);
-                margin-bottom: 30px;
-            }}
-
-            .celebration-badge {{
-                display: inline-block;
-                background: rgba(255, 255, 255, 0.2);
-                backdrop-filter: blur(10px);
-                border: 1px solid rgba(255, 255, 255, 0.3);
-                border-radius: 50px;
-                padding: 15px 30px;
-                font-size: 16px;
-                font-weight: 600;
-                color: #ffffff;
-                box-shadow: 0 8px 24px rgba(0, 0, 0, 0.2);
-            }}
-
-            .content-section {{
-                padding: 50px 40px;
-                background: #ffffff;
-            }}
-
-            .message-content {{
-                font-size: 16px;
-                line-height: 1.7;
-                color: #4b5563;
-                white-space: pre-line;
-            }}
-
-            .signature {{
-                text-align: center;
-                margin-top: 40px;
-                padding-top: 30px;
-                border-top: 2px solid #e5e7eb;
-            }}
-
-            .signature-name {{
-                font-size: 18px;
-                font-weight: 600;
-                color: #374151;
-                margin-bottom: 5px;
-            }}
-
-            .signature-role {{
-                font-size: 14px;
-                color: #6b7280;
-            }}
-
-            .footer {{
-                background: linear-gradient(135deg, #1f2937 0%, #374151 100%);
-                padding: 40px 40px 30px;
-                text-align: center;
-                color: #ffffff;
-            }}
-
-            .footer-title {{
-                font-size: 18px;
-                font-weight: 600;
-                margin-bottom: 10px;
-            }}
-
-            .footer-subtitle {{
-                font-size: 14px;
-                opacity: 0.9;
-                margin-bottom: 20px;
-            }}
-
-            .contact-info {{
-                font-size: 14px;
-                line-height: 1.6;
-                opacity: 0.8;
-            }}
-
-            .disclaimer {{
-                margin-top: 30px;
-                padding-top: 20px;
-                border-top: 1px solid rgba(255, 255, 255, 0.1);
-                font-size: 12px;
-                opacity: 0.6;
-                line-height: 1.5;
-            }}
-
-            @media (max-width: 600px) {{
-                .email-container {{
-                    margin: 10px;
-                    border-radius: 16px;
-                }}
-
-                .hero-section {{
-                    padding: 40px 30px;
-                }}
-
-                .club-title {{
-                    font-size: 32px;
-                }}
-
-                .content-section {{
-                    padding: 30px 25px;
-                }}
-
-                .footer {{
-                    padding: 30px 25px 20px;
-                }}
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="email-container">
-            <!-- Hero Section -->
-            <div class="hero-section">
-                <div class="hero-content">
-                    <div class="logo-section">
-                        <img src="cid:logo_main" alt="INTERSTELLAR CLUB" style="height: 70px; margin: 0 15px; border-radius: 8px; box-shadow: 0 4px 8px rgba(0,0,0,0.2);">
-                        <img src="cid:logo_secondary" alt="Second Logo" style="height: 55px; margin: 0 15px; border-radius: 6px; box-shadow: 0 4px 8px rgba(0,0,0,0.2);">
-                    </div>
-                    <h1 class="club-title">{title_emoji} INTERSTELLAR CLUB</h1>
-                    <p class="club-subtitle">Club Universitaire d'Innovation Scientifique</p>
-                    <div class="celebration-badge">{badge_text}</div>
-                </div>
-            </div>
-
-            <!-- Content Section -->
-            <div class="content-section">
-                <div class="message-content">
-                    {body}
-                </div>
-
-                <div class="signature">
-                    <div class="signature-name">Cordialement,</div>
-                    <div class="signature-role">L'équipe INTERSTELLAR CLUB</div>
-                </div>
-            </div>
-
-            <!-- Footer -->
-            <div class="footer">
-                <div class="footer-title">INTERSTELLAR CLUB</div>
-                <div class="footer-subtitle">Club Universitaire d'Innovation Scientifique</div>
-
-                <div class="contact-info">
-                    Cet email a été envoyé automatiquement depuis notre plateforme.<br>
-                    Pour toute question, contactez-nous à l'adresse universitaire.
-                </div>
-
-                <div class="disclaimer">
-                    🔒 Cet email contient des informations confidentielles.<br>
-                    INTERSTELLAR CLUB - Tous droits réservés © 2025
-                </div>
-            </div>
-        </div>
-    </body>
-    </html>
-    """
+    """Render the HTML email for a plain text body, themed by email_type"""
+    if email_type == "verification_code":
+        # The body of a verification code email is the code itself
+        return verification_code_email_template.render(code=body, ttl_minutes=VERIFICATION_CODE_TTL // 60)
+    return email_message_template.render(
+        theme=EMAIL_THEMES.get(email_type, EMAIL_THEMES["general"]),
+        subject=subject.replace('🎉', '').replace('📧', '').strip(),
+        body=body,
+    )
 
-    return beautiful_html
+async def deliver_email(recipients, subject, body, attachments=None, email_type="general"):
+    """Send a plain text email with INTERSTELLAR CLUB logos; logs to console if SMTP not configured.
 
-def send_email(recipients, subject, body, attachments=None, email_type="general"):
-    """Send a plain text email with INTERSTELLAR CLUB logos; logs to console if SMTP not configured."""
+    Called by the outbox sender. Failures are logged and re-raised so the message is retried.
+    """
     if isinstance(recipients, str):
         recipients = [recipients]
     if not recipients:
@@ -538,28 +1017,16 @@ def send_email(recipients, subject, body, attachments=None, email_type="general"
     html_part = MIMEText(html_body, "html", "utf-8")
     msg.attach(html_part)
 
-    # Attach logos as inline images
-    logo_paths = ["static/logo.png", "static/logo1.png"]
-    logo_cids = ["logo_main", "logo_secondary"]
-
-    for i, logo_path in enumerate(logo_paths):
-        try:
-            if os.path.exists(logo_path):
-                with open(logo_path, "rb") as f:
-                    logo_part = MIMEImage(f.read())
-                    logo_part.add_header('Content-ID', f'<{logo_cids[i]}>')
-                    logo_part.add_header('Content-Disposition', 'inline')
-                    msg.attach(logo_part)
-        except Exception as e:
-            print(f"Logo attachment failed ({logo_path}):", e)
+    # Attach logos as inline images (prepared once, see email_assets)
+    for logo_part in email_assets.parts():
+        msg.attach(logo_part)
 
     # Attach additional files if provided
     attachments = attachments or []
     for path in attachments:
         try:
-            with open(path, "rb") as f:
-                part = MIMEBase("application", "octet-stream")
-                part.set_payload(f.read())
+            part = MIMEBase("application", "octet-stream")
+            part.set_payload(await asyncio.get_running_loop().run_in_executor(None, Path(path).read_bytes))
             encoders.encode_base64(part)
             part.add_header("Content-Disposition", f'attachment; filename="{os.path.basename(path)}"')
             msg.attach(part)
@@ -570,65 +1037,33 @@ def send_email(recipients, subject, body, attachments=None, email_type="general"
         print(f"EMAIL: Attempting to send email to: {recipients}")
         print(f"EMAIL: Subject: {subject}")
 
-        # Send via Gmail - Try TLS first, then SSL if it fails
-        print("EMAIL: Connecting to SMTP server...")
-        success = False
+        # Send via Gmail over a pooled connection (TLS first, then SSL, see open_smtp_connection)
+        print("EMAIL: Sending email...")
+        await smtp_pool.send(EMAIL_FROM, recipients, msg.as_string())
+        print("EMAIL: Email sent successfully!")
 
-        # Try TLS first (port 587)
-        if EMAIL_PORT == 587:
-            try:
-                server = smtplib.SMTP(EMAIL_HOST, EMAIL_PORT, timeout=10)
-                print("EMAIL: Starting TLS...")
-                server.starttls()
-                print("EMAIL: Logging in...")
-                server.login(EMAIL_USER, EMAIL_PASS)
-                print("EMAIL: Sending email...")
-                server.sendmail(EMAIL_FROM, recipients, msg.as_string())
-                server.quit()
-                print("EMAIL: Email sent successfully!")
-                success = True
-            except Exception as tls_error:
-                print(f"EMAIL: TLS failed, trying SSL: {tls_error}")
-                success = False
-
-        # If TLS failed or using SSL port, try SSL (port 465)
-        if not success:
-            try:
-                print("EMAIL: Trying SSL connection...")
-                server = smtplib.SMTP_SSL(EMAIL_HOST, 465, timeout=10)
-                print("EMAIL: Logging in...")
-                server.login(EMAIL_USER, EMAIL_PASS)
-                print("EMAIL: Sending email...")
-                server.sendmail(EMAIL_FROM, recipients, msg.as_string())
-                server.quit()
-                print("EMAIL: Email sent successfully!")
-                success = True
-            except Exception as ssl_error:
-                print(f"EMAIL: SSL also failed: {ssl_error}")
-                raise ssl_error
-
-        if not success:
-            raise Exception("Both TLS and SSL failed")
-
-    except smtplib.SMTPAuthenticationError as e:
+    except aiosmtplib.SMTPAuthenticationError as e:
         print(f"EMAIL ERROR: Authentication failed: {e}")
         print("TIP: For Gmail: Make sure you use App Password, not regular password")
         print("TIP: Generate App Password at: https://myaccount.google.com/apppasswords")
-    except smtplib.SMTPConnectError as e:
+        raise
+    except aiosmtplib.SMTPConnectError as e:
         print(f"EMAIL ERROR: Connection failed: {e}")
         print("TIP: Check your internet connection")
-    except smtplib.SMTPException as e:
+        raise
+    except aiosmtplib.SMTPException as e:
         error_str = str(e).lower()
         if "blocked" in error_str or "rejected" in error_str:
             print(f"EMAIL ERROR: Email blocked by Gmail: {e}")
             print("TIP: Gmail is blocking emails to university/student addresses from personal accounts")
             print("SOLUTION: Use university email or professional email service (SendGrid, Mailgun)")
             print("TIP: Create .env file with university email settings")
-        elif "daily" in error_str or "limit" in error_str:
+        elif is_sending_limit_error(e):
             print(f"EMAIL ERROR: Daily sending limit exceeded: {e}")
             print("TIP: Gmail daily limit exceeded. Wait 24 hours or use different account")
         else:
             print(f"EMAIL ERROR: SMTP error: {e}")
+        raise
     except Exception as e:
         error_str = str(e).lower()
         if "blocked" in error_str or "rejected" in error_str or "university" in error_str:
@@ -638,6 +1073,412 @@ def send_email(recipients, subject, body, attachments=None, email_type="general"
         else:
             print(f"EMAIL ERROR: Unexpected error: {e}")
             print("TIP: Check your email configuration in .env file")
+        raise
+
+# Email outbox
+# send_email() only records the message in email_outbox, so request handlers never wait on
+# SMTP. A background task in every worker claims due rows and delivers them; failures are
+# retried after EMAIL_RETRY_BASE * 2^(attempts-1) seconds (capped at EMAIL_RETRY_MAX) and
+# dead-lettered after EMAIL_MAX_ATTEMPTS. Claimed rows are leased for EMAIL_SEND_LEASE
+# seconds, so a message whose worker died mid-send is picked up again. A worker only claims
+# as many messages as it has free SMTP connections and claims again whenever one frees up, so
+# a verification code queued behind a slow delivery waits for one slot, not a whole batch.
+# The sender's own bookkeeping runs on the sync engine in a thread, each step committed in
+# one call: an async transaction left open across an await could hold the SQLite write lock
+# while a sync-session route blocks the event loop, stalling both until busy_timeout.
+EMAIL_MAX_ATTEMPTS = env_int("EMAIL_MAX_ATTEMPTS", 6)
+EMAIL_RETRY_BASE = env_int("EMAIL_RETRY_BASE", 30)
+EMAIL_RETRY_MAX = env_int("EMAIL_RETRY_MAX", 3600)
+EMAIL_SEND_LEASE = env_int("EMAIL_SEND_LEASE", 300)
+EMAIL_OUTBOX_POLL = env_int("EMAIL_OUTBOX_POLL", 5)
+EMAIL_OUTBOX_BATCH = env_int("EMAIL_OUTBOX_BATCH", 20)  # due rows considered per claim
+EMAIL_OUTBOX_RETENTION_DAYS = env_int("EMAIL_OUTBOX_RETENTION_DAYS", 7)
+# Due messages are claimed highest priority first. HIGH is for mail a user is waiting on
+# right now (verification codes); it is never batched into digests. LOW is for bulk notices
+# (professor notifications), which give way to the others when the sending quota runs low.
+EMAIL_PRIORITY_HIGH = 2
+EMAIL_PRIORITY_NORMAL = 1
+EMAIL_PRIORITY_LOW = 0
+
+def outbox_message(recipients, subject, body, attachments=None, email_type="general", priority=EMAIL_PRIORITY_NORMAL):
+    return EmailOutbox(
+        recipients=json.dumps(recipients), recipient_count=len(recipients), subject=subject, body=body,
+        attachments=json.dumps(attachments or []), email_type=email_type, priority=priority,
+    )
+
+async def send_email(recipients, subject, body, attachments=None, email_type="general", priority=EMAIL_PRIORITY_NORMAL):
+    """Queue an email for background delivery by the outbox sender"""
+    if isinstance(recipients, str):
+        recipients = [recipients]
+    if not recipients:
+        return
+    async with AsyncSessionLocal() as db:
+        db.add(outbox_message(recipients, subject, body, attachments, email_type, priority))
+        await db.commit()
+    wakeup = getattr(app.state, "email_outbox_wakeup", None)
+    if wakeup is not None:
+        wakeup.set()
+
+# Sending governor
+# Keeps delivery under the provider's quotas (a personal Gmail account allows about 500
+# recipients a day). Usage is counted from email_outbox over a rolling minute and day, so
+# every worker sees the same numbers, and claims are serialized so two workers cannot both
+# spend the last of the budget. LOW priority mail stops EMAIL_QUOTA_RESERVE recipients short
+# of the daily limit, keeping room for verification codes and approval notices; mail over
+# budget simply waits in the outbox. If the provider still reports a sending limit, delivery
+# pauses for EMAIL_QUOTA_BACKOFF seconds without using up retry attempts; the pause is stored
+# in email_sending_pause and checked under the claim lock, so it stops every worker.
+EMAIL_QUOTA_PER_MINUTE = env_int("EMAIL_QUOTA_PER_MINUTE", 20)
+EMAIL_QUOTA_MESSAGES_PER_DAY = env_int("EMAIL_QUOTA_MESSAGES_PER_DAY", 500)
+EMAIL_QUOTA_RECIPIENTS_PER_DAY = env_int("EMAIL_QUOTA_RECIPIENTS_PER_DAY", 500)
+EMAIL_QUOTA_RESERVE = env_int("EMAIL_QUOTA_RESERVE", 50)
+EMAIL_QUOTA_BACKOFF = env_int("EMAIL_QUOTA_BACKOFF", 3600)
+EMAIL_SENDING_PAUSE_ID = 1
+email_governor = {"notice": None}
+
+# Only genuine quota replies pause delivery: a transient or policy reply code whose text says
+# so, or an enhanced status code reserved for rate limiting (4.7.x, 5.4.5 for Gmail's daily
+# quota). Anything else, e.g. "552 5.2.3 ... message size limits", is an ordinary failure.
+SENDING_LIMIT_REPLY_CODES = {421, 450, 451, 550}
+SENDING_LIMIT_PHRASES = ("sending limit", "daily", "rate limit", "quota")
+SENDING_LIMIT_STATUS = re.compile(r"\b(?:4\.7\.\d{1,3}|5\.4\.5)\b")
+
+def is_sending_limit_error(e):
+    if isinstance(e, aiosmtplib.SMTPRecipientsRefused):
+        return any(is_sending_limit_error(refused) for refused in e.recipients)
+    code = getattr(e, "code", None)
+    if not isinstance(e, aiosmtplib.SMTPResponseException) or code is None:
+        return False
+    message = str(e.message).lower()
+    if SENDING_LIMIT_STATUS.search(message):
+        return True
+    return code in SENDING_LIMIT_REPLY_CODES and any(phrase in message for phrase in SENDING_LIMIT_PHRASES)
+
+def lock_outbox_claims(conn):
+    """Serialize quota checks and claims between workers until the transaction ends"""
+    if conn.dialect.name == "sqlite":
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+    elif conn.dialect.name == "postgresql":
+        conn.exec_driver_sql("SELECT pg_advisory_xact_lock(47110002)")
+
+def sending_paused_until(db, now):
+    paused_until = db.scalar(select(EmailSendingPause.paused_until).where(EmailSendingPause.id == EMAIL_SENDING_PAUSE_ID))
+    return paused_until if paused_until and paused_until > now else None
+
+def pause_email_sending(paused_until, reason):
+    """Stop every worker's deliveries until paused_until (an existing longer pause is kept)"""
+    with SessionLocal() as db:
+        lock_outbox_claims(db.connection())
+        pause = db.get(EmailSendingPause, EMAIL_SENDING_PAUSE_ID)
+        if pause is None:
+            db.add(EmailSendingPause(id=EMAIL_SENDING_PAUSE_ID, paused_until=paused_until, reason=reason))
+        elif pause.paused_until is None or pause.paused_until < paused_until:
+            pause.paused_until = paused_until
+            pause.reason = reason
+        db.commit()
+
+def email_quota_usage(db):
+    """Messages and recipients sent (or in flight) over the last minute and day"""
+    now = datetime.utcnow()
+    in_flight = EmailOutbox.status == "sending"
+    last_minute = or_(in_flight, (EmailOutbox.status == "sent") & (EmailOutbox.sent_at >= now - timedelta(minutes=1)))
+    last_day = or_(in_flight, (EmailOutbox.status == "sent") & (EmailOutbox.sent_at >= now - timedelta(days=1)))
+    row = db.execute(
+        select(
+            func.sum(case((last_minute, 1), else_=0)).label("minute_messages"),
+            func.count().label("day_messages"),
+            func.sum(EmailOutbox.recipient_count).label("day_recipients"),
+        ).where(last_day)
+    ).one()
+    return {key: int(value or 0) for key, value in row._mapping.items()}
+
+def email_quota_report():
+    """Current usage against the limits, plus the queue, for the /email/quota endpoint"""
+    with SessionLocal() as db:
+        usage = email_quota_usage(db)
+        queued = db.execute(
+            select(EmailOutbox.priority, func.count()).where(EmailOutbox.status == "pending").group_by(EmailOutbox.priority)
+        ).all()
+        dead = db.scalar(select(func.count()).where(EmailOutbox.status == "dead"))
+        paused_until = sending_paused_until(db, datetime.utcnow())
+    priority_names = {EMAIL_PRIORITY_HIGH: "high", EMAIL_PRIORITY_NORMAL: "normal", EMAIL_PRIORITY_LOW: "low"}
+    return {
+        "minute": {"messages": usage["minute_messages"], "limit": EMAIL_QUOTA_PER_MINUTE},
+        "day": {
+            "messages": usage["day_messages"], "messages_limit": EMAIL_QUOTA_MESSAGES_PER_DAY,
+            "recipients": usage["day_recipients"], "recipients_limit": EMAIL_QUOTA_RECIPIENTS_PER_DAY,
+            "low_priority_reserve": EMAIL_QUOTA_RESERVE,
+        },
+        "queued": {priority_names.get(priority, str(priority)): count for priority, count in queued},
+        "dead": dead,
+        "paused_until": paused_until.isoformat() if paused_until else None,
+    }
+
+def governor_notice(notice):
+    """Log quota state changes once instead of on every poll"""
+    if notice != email_governor["notice"]:
+        email_governor["notice"] = notice
+        if notice:
+            print(f"EMAIL GOVERNOR: {notice}")
+
+def claim_outbox_messages(limit=EMAIL_OUTBOX_BATCH):
+    """Lease up to limit due messages to this worker, highest priority first, within the sending quotas"""
+    now = datetime.utcnow()
+    token = secrets.token_hex(8)
+    is_due = [EmailOutbox.status.in_(["pending", "sending"]), EmailOutbox.next_attempt_at <= now]
+    with SessionLocal() as db:
+        # Read first so an idle poll never takes the write lock
+        if db.scalar(select(EmailOutbox.id).where(*is_due).limit(1)) is None:
+            return []
+    with SessionLocal() as db:
+        lock_outbox_claims(db.connection())
+        # Checked under the lock so no worker claims after another one recorded a pause
+        paused_until = sending_paused_until(db, now)
+        if paused_until:
+            db.rollback()
+            governor_notice(f"provider sending limit reached, delivery paused until {paused_until:%Y-%m-%d %H:%M} UTC")
+            return []
+        usage = email_quota_usage(db)
+        messages_left = min(
+            limit,
+            EMAIL_QUOTA_PER_MINUTE - usage["minute_messages"],
+            EMAIL_QUOTA_MESSAGES_PER_DAY - usage["day_messages"],
+        )
+        recipients_left = EMAIL_QUOTA_RECIPIENTS_PER_DAY - usage["day_recipients"]
+        candidates = db.execute(
+            select(EmailOutbox.id, EmailOutbox.priority, EmailOutbox.recipient_count).where(*is_due)
+            .order_by(EmailOutbox.priority.desc(), EmailOutbox.next_attempt_at).limit(EMAIL_OUTBOX_BATCH)
+        ).all()
+        due_ids = []
+        for candidate in candidates:
+            if len(due_ids) >= messages_left:
+                break
+            reserve = EMAIL_QUOTA_RESERVE if candidate.priority <= EMAIL_PRIORITY_LOW else 0
+            if candidate.recipient_count <= recipients_left - reserve:
+                due_ids.append(candidate.id)
+                recipients_left -= candidate.recipient_count
+        if not due_ids:
+            db.rollback()
+            governor_notice(
+                f"quota reached (last minute {usage['minute_messages']}/{EMAIL_QUOTA_PER_MINUTE} messages, "
+                f"last day {usage['day_messages']}/{EMAIL_QUOTA_MESSAGES_PER_DAY} messages and "
+                f"{usage['day_recipients']}/{EMAIL_QUOTA_RECIPIENTS_PER_DAY} recipients), outgoing mail is waiting"
+            )
+            return []
+        governor_notice(None)
+        # Re-checking the due condition in the UPDATE keeps two workers from claiming the same row
+        db.execute(
+            update(EmailOutbox).where(EmailOutbox.id.in_(due_ids), *is_due)
+            .values(status="sending", claim_token=token, next_attempt_at=now + timedelta(seconds=EMAIL_SEND_LEASE))
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+        messages = db.scalars(select(EmailOutbox).where(EmailOutbox.claim_token == token)).all()
+        db.expunge_all()
+        # Deliver in the order of the claim (priority, then due time)
+        claim_order = {message_id: position for position, message_id in enumerate(due_ids)}
+        return sorted(messages, key=lambda message: claim_order[message.id])
+
+def finish_outbox_message(message: EmailOutbox, values: dict):
+    with SessionLocal() as db:
+        db.execute(
+            update(EmailOutbox).where(EmailOutbox.id == message.id, EmailOutbox.claim_token == message.claim_token)
+            .values(claim_token=None, **values)
+        )
+        db.commit()
+
+async def deliver_outbox_message(message: EmailOutbox):
+    loop = asyncio.get_running_loop()
+    attempts = message.attempts + 1
+    # A verification code is useless once it has expired, so it is never retried past that
+    code_expires_at = None
+    if message.email_type == "verification_code":
+        code_expires_at = message.created_at + timedelta(seconds=VERIFICATION_CODE_TTL)
+        if datetime.utcnow() >= code_expires_at:
+            print(f"EMAIL DEAD-LETTER: outbox #{message.id} verification code expired before delivery")
+            values = dict(status="dead", body="", last_error="verification code expired before delivery")
+            await loop.run_in_executor(None, finish_outbox_message, message, dict(values, attempts=message.attempts))
+            return
+    try:
+        await deliver_email(
+            json.loads(message.recipients), message.subject, message.body,
+            json.loads(message.attachments), message.email_type,
+        )
+        sent_at = datetime.utcnow()
+        values = dict(status="sent", sent_at=sent_at, last_error=None)
+        print(f"EMAIL OUTBOX: #{message.id} ({message.email_type}) sent {(sent_at - message.created_at).total_seconds():.1f}s after queueing")
+    except Exception as e:
+        if is_sending_limit_error(e):
+            # Over the provider's quota: pause this worker and requeue without using an attempt
+            attempts = message.attempts
+            paused_until = datetime.utcnow() + timedelta(seconds=EMAIL_QUOTA_BACKOFF)
+            await loop.run_in_executor(None, pause_email_sending, paused_until, str(e)[:1000])
+            governor_notice(f"provider sending limit reached, delivery paused until {paused_until:%Y-%m-%d %H:%M} UTC")
+            values = dict(status="pending", next_attempt_at=paused_until)
+        # Refused recipients will not be accepted on a later attempt either
+        elif (attempts >= EMAIL_MAX_ATTEMPTS or isinstance(e, aiosmtplib.SMTPRecipientsRefused)
+              or (code_expires_at and datetime.utcnow() >= code_expires_at)):
+            print(f"EMAIL DEAD-LETTER: outbox #{message.id} to {message.recipients} after {attempts} attempts: {e}")
+            values = dict(status="dead")
+        else:
+            delay = min(EMAIL_RETRY_MAX, EMAIL_RETRY_BASE * 2 ** (attempts - 1))
+            print(f"EMAIL RETRY: outbox #{message.id} attempt {attempts} failed, next try in {delay}s")
+            values = dict(status="pending", next_attempt_at=datetime.utcnow() + timedelta(seconds=delay))
+        values["last_error"] = str(e)[:1000]
+    if code_expires_at and values["status"] in ("sent", "dead"):
+        # Only the hash of a code is kept (verification_codes); do not leave it here in clear
+        values["body"] = ""
+    await loop.run_in_executor(None, finish_outbox_message, message, dict(values, attempts=attempts))
+
+async def run_email_outbox(wakeup: asyncio.Event):
+    in_flight = set()
+
+    def delivery_done(delivery: asyncio.Task):
+        in_flight.discard(delivery)
+        if not delivery.cancelled() and delivery.exception() is not None:
+            print(f"EMAIL OUTBOX: sender error: {delivery.exception()}")
+
+    try:
+        while True:
+            free_slots = EMAIL_SMTP_POOL_SIZE - len(in_flight)
+            if free_slots > 0:
+                try:
+                    messages = await asyncio.get_running_loop().run_in_executor(None, claim_outbox_messages, free_slots)
+                except Exception as e:
+                    print(f"EMAIL OUTBOX: sender error: {e}")
+                    messages = []
+                for message in messages:
+                    delivery = asyncio.create_task(deliver_outbox_message(message))
+                    in_flight.add(delivery)
+                    delivery.add_done_callback(delivery_done)
+            # Claim again when a delivery finishes, send_email() is called in this worker or,
+            # for mail queued by the other workers, after EMAIL_OUTBOX_POLL seconds
+            woken = asyncio.create_task(wakeup.wait())
+            try:
+                await asyncio.wait({woken, *in_flight}, timeout=EMAIL_OUTBOX_POLL, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                woken.cancel()
+            wakeup.clear()
+    finally:
+        for delivery in in_flight:
+            delivery.cancel()
+        await asyncio.gather(*in_flight, return_exceptions=True)
+
+@app.on_event("startup")
+async def start_email_outbox():
+    app.state.email_outbox_wakeup = asyncio.Event()
+    app.state.email_outbox_task = asyncio.create_task(run_email_outbox(app.state.email_outbox_wakeup))
+
+@app.on_event("shutdown")
+async def stop_email_outbox():
+    # Wait for the cancelled deliveries to give their pool slots back before closing the pool
+    app.state.email_outbox_task.cancel()
+    await asyncio.gather(app.state.email_outbox_task, return_exceptions=True)
+    await smtp_pool.close_all()
+
+# Professor registration notifications
+# PROFESSOR_NOTIFICATIONS=immediate (default) emails the professors on every student
+# registration, with the student card attached. PROFESSOR_NOTIFICATIONS=digest sends them
+# instead one summary every PROFESSOR_DIGEST_INTERVAL seconds listing the students registered
+# since the previous one that are still pending, with links to the cards rather than the
+# files. Listed students get registration_notified_at in the same transaction that queues
+# the summary and records it in notification_digests, under the outbox claim lock, so with
+# several workers each registration is reported once, whatever order registrations commit in.
+PROFESSOR_NOTIFICATION_MODES = ("immediate", "digest")
+PROFESSOR_NOTIFICATIONS = (os.getenv("PROFESSOR_NOTIFICATIONS") or "immediate").lower()
+if PROFESSOR_NOTIFICATIONS not in PROFESSOR_NOTIFICATION_MODES:
+    raise ValueError(f"Unknown PROFESSOR_NOTIFICATIONS {PROFESSOR_NOTIFICATIONS!r}, expected one of {list(PROFESSOR_NOTIFICATION_MODES)}")
+PROFESSOR_DIGEST_INTERVAL = env_int("PROFESSOR_DIGEST_INTERVAL", 3600)
+PROFESSOR_DIGEST_NAME = "professor_registrations"
+
+def upload_url(base_url, path):
+    """Public URL of a file saved under uploads/; stored paths may use Windows separators and
+    contain spaces or accented characters"""
+    return base_url + "/" + quote(path.replace("\\", "/"))
+
+def professor_digest_body(students, pending_total, base_url):
+    lines = [f"Nouvelles demandes d'inscription d'étudiants depuis le dernier récapitulatif : {len(students)}", ""]
+    for student in students:
+        card_link = upload_url(base_url, student.student_card_image) if student.student_card_image else "Non attachée"
+        registered_at = student.created_at.strftime("%d/%m/%Y %H:%M") if student.created_at else "Inconnue"
+        lines += [
+            f"• {student.first_name} {student.last_name} ({student.username})",
+            f"Email: {student.email}",
+            f"Spécialité: {student.specialty or 'Non spécifiée'}",
+            f"Numéro de carte d'étudiant: {student.student_id_number or 'Non spécifié'}",
+            f"Inscrit le: {registered_at}",
+            f"Carte d'étudiant: {card_link}",
+            f"Pour approuver: {base_url}/students/{student.id}/approve",
+            f"Pour refuser: {base_url}/students/{student.id}/reject",
+            "",
+        ]
+    lines.append(f"Demandes en attente au total : {pending_total}")
+    lines.append(f"Tableau de bord : {base_url}/dashboard")
+    return "\n".join(lines)
+
+def queue_professor_digest():
+    """Queue the registration summary if the interval has elapsed; returns the number of students listed"""
+    now = datetime.utcnow()
+    due_before = now - timedelta(seconds=PROFESSOR_DIGEST_INTERVAL)
+    is_pending_student = [User.role == "Student", User.approval_status == "pending"]
+    is_unreported = [*is_pending_student, User.registration_notified_at.is_(None)]
+    with SessionLocal() as db:
+        # Read first so an idle check never takes the write lock
+        last_sent_at = db.scalar(select(NotificationDigest.sent_at).where(NotificationDigest.name == PROFESSOR_DIGEST_NAME))
+        if last_sent_at and last_sent_at > due_before:
+            return 0
+        if db.scalar(select(User.id).where(*is_unreported).limit(1)) is None:
+            return 0
+    with SessionLocal() as db:
+        lock_outbox_claims(db.connection())
+        state = db.get(NotificationDigest, PROFESSOR_DIGEST_NAME)
+        if state is None:
+            state = NotificationDigest(name=PROFESSOR_DIGEST_NAME)
+            db.add(state)
+        elif state.sent_at and state.sent_at > due_before:
+            db.rollback()
+            return 0
+        students = db.scalars(select(User).where(*is_unreported).order_by(User.id)).all()
+        prof_emails = db.scalars(select(User.email).where(User.role == "Professor", User.email.isnot(None), User.email != "")).all()
+        if not students or not prof_emails:
+            db.rollback()
+            return 0
+        pending_total = db.scalar(select(func.count()).select_from(User).where(*is_pending_student))
+        base_url = os.getenv("BASE_URL", "http://localhost:8000")
+        db.add(outbox_message(
+            list(prof_emails), f"Récapitulatif des demandes d'inscription ({len(students)} nouvelles)",
+            professor_digest_body(students, pending_total, base_url), email_type="notification", priority=EMAIL_PRIORITY_LOW,
+        ))
+        db.execute(
+            update(User).where(User.id.in_([student.id for student in students]))
+            .values(registration_notified_at=now).execution_options(synchronize_session=False)
+        )
+        state.sent_at = now
+        db.commit()
+        return len(students)
+
+async def run_professor_digest():
+    while True:
+        # Checking more often than the interval lets a new worker pick up where the others left off
+        await asyncio.sleep(min(PROFESSOR_DIGEST_INTERVAL, 60))
+        try:
+            listed = await asyncio.get_running_loop().run_in_executor(None, queue_professor_digest)
+            if listed:
+                print(f"PROFESSOR DIGEST: queued summary of {listed} registrations")
+                app.state.email_outbox_wakeup.set()
+        except Exception as e:
+            print(f"PROFESSOR DIGEST: failed to queue summary: {e}")
+
+@app.on_event("startup")
+async def start_professor_digest():
+    app.state.professor_digest_task = None
+    if PROFESSOR_NOTIFICATIONS == "digest":
+        app.state.professor_digest_task = asyncio.create_task(run_professor_digest())
+
+@app.on_event("shutdown")
+async def stop_professor_digest():
+    if app.state.professor_digest_task is not None:
+        app.state.professor_digest_task.cancel()
 
 # Dependency
 def get_db():
@@ -647,44 +1488,498 @@ def get_db():
     finally:
         db.close()
 
-# Simple session management
-current_user_id = None
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
 
-# Verification codes storage (temporary - in production use database)
-current_user_verification_codes = {}
+async def get_read_db():
+    """Session for GET routes: bound to the read engine, closed without flush or commit"""
+    async with ReadSessionLocal() as db:
+        yield db
 
-def get_current_user(db: Session):
-    if not current_user_id:
+class TTLCache:
+    """Small in-process LRU cache whose entries expire after a TTL (seconds)"""
+
+    def __init__(self, ttl, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (value, expires_at timestamp)
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        value, expires_at = entry
+        if expires_at < time.time():
+            del self.entries[key]
+            return default
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.entries[key] = (value, time.time() + (self.ttl if ttl is None else ttl))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def pop(self, key):
+        self.entries.pop(key, None)
+
+# Session management
+# The cookie carries a random session id signed with SECRET_KEY; the store maps the SHA-256
+# of that id to a user id. SESSION_STORE=database (default) shares sessions between all
+# workers through the sessions table, SESSION_STORE=memory keeps them in this process only.
+SESSION_COOKIE_NAME = "interstellar_session"
+SESSION_TTL = env_int("SESSION_TTL", 12 * 3600)
+SESSION_COOKIE_SECURE = env_bool("SESSION_COOKIE_SECURE", False)
+
+def load_secret_key(path: str = ".session_secret"):
+    key = os.getenv("SECRET_KEY")
+    if key:
+        return key
+    # Without SECRET_KEY the workers of this machine share a generated key through a file;
+    # it is written to a temp file first and linked into place so no worker reads it half-written
+    key_path = Path(path)
+    if not key_path.exists():
+        tmp_path = Path(f"{path}.{os.getpid()}")
+        tmp_path.write_text(secrets.token_hex(32), encoding="utf-8")
+        try:
+            os.link(tmp_path, key_path)
+        except FileExistsError:
+            pass
+        finally:
+            tmp_path.unlink()
+    print("WARNING: SECRET_KEY not set, using the generated key in", path)
+    return key_path.read_text(encoding="utf-8").strip()
+
+SECRET_KEY = load_secret_key()
+
+class MemorySessionStore:
+    """In-process LRU with TTL; sessions are only visible to the worker that created them"""
+
+    def __init__(self, max_entries=10000):
+        self.cache = TTLCache(SESSION_TTL, max_entries)
+
+    async def get(self, key):
+        return self.cache.get(key)
+
+    async def create(self, key, user_id, ttl):
+        self.cache.set(key, user_id, ttl)
+
+    async def delete(self, key):
+        self.cache.pop(key)
+
+class DatabaseSessionStore:
+    """Sessions table in the application database, shared by every worker"""
+
+    async def get(self, key):
+        async with AsyncSessionLocal() as db:
+            row = (await db.execute(
+                select(UserSession.user_id, UserSession.expires_at).where(UserSession.id == key)
+            )).first()
+        if row is None or row.expires_at < datetime.utcnow():
+            return None
+        return row.user_id
+
+    async def create(self, key, user_id, ttl):
+        now = datetime.utcnow()
+        async with AsyncSessionLocal() as db:
+            # Expired rows are purged on login, using the expires_at index
+            await db.execute(delete(UserSession).where(UserSession.expires_at < now))
+            db.add(UserSession(id=key, user_id=user_id, created_at=now, expires_at=now + timedelta(seconds=ttl)))
+            await db.commit()
+
+    async def delete(self, key):
+        async with AsyncSessionLocal() as db:
+            await db.execute(delete(UserSession).where(UserSession.id == key))
+            await db.commit()
+
+SESSION_STORES = {"database": DatabaseSessionStore, "memory": MemorySessionStore}
+SESSION_STORE = (os.getenv("SESSION_STORE") or "database").lower()
+if SESSION_STORE not in SESSION_STORES:
+    raise ValueError(f"Unknown SESSION_STORE {SESSION_STORE!r}, expected one of {sorted(SESSION_STORES)}")
+session_store = SESSION_STORES[SESSION_STORE]()
+
+def session_store_key(session_id: str) -> str:
+    return hashlib.sha256(session_id.encode()).hexdigest()
+
+def sign_session_id(session_id: str) -> str:
+    signature = hmac.new(SECRET_KEY.encode(), session_id.encode(), hashlib.sha256).hexdigest()
+    return f"{session_id}.{signature}"
+
+def unsign_session_id(cookie_value: str):
+    """Return the session id from a signed cookie value, or None if the signature is wrong"""
+    session_id, _, signature = (cookie_value or "").rpartition(".")
+    if not session_id:
         return None
-    return db.query(User).filter(User.id == current_user_id).first()
+    expected = hmac.new(SECRET_KEY.encode(), session_id.encode(), hashlib.sha256).hexdigest()
+    return session_id if hmac.compare_digest(signature, expected) else None
+
+async def start_session(response, user_id: int):
+    session_id = secrets.token_urlsafe(32)
+    await session_store.create(session_store_key(session_id), user_id, SESSION_TTL)
+    response.set_cookie(
+        SESSION_COOKIE_NAME, sign_session_id(session_id),
+        max_age=SESSION_TTL, httponly=True, samesite="lax", secure=SESSION_COOKIE_SECURE,
+    )
 
-def require_prof_or_admin(user: User):
+async def end_session(request: Request, response):
+    session_id = unsign_session_id(request.cookies.get(SESSION_COOKIE_NAME))
+    if session_id:
+        await session_store.delete(session_store_key(session_id))
+    response.delete_cookie(SESSION_COOKIE_NAME)
+
+async def get_session_user_id(request: Request):
+    """Resolve the signed session cookie to a user id (None when not logged in)"""
+    session_id = unsign_session_id(request.cookies.get(SESSION_COOKIE_NAME))
+    if not session_id:
+        return None
+    return await session_store.get(session_store_key(session_id))
+
+# Rate limiting
+# Token buckets per client IP and per target account (username or email) for the routes that
+# cost a password hash or an email. A rule "N/S" allows bursts of N requests, refilled at N
+# per S seconds; override one with e.g. RATE_LIMIT_LOGIN_ACCOUNT=5/60 (0 disables it).
+# RATE_LIMIT_STORE=database (default) shares the buckets between workers through the
+# rate_limit_buckets table, RATE_LIMIT_STORE=memory counts per process only.
+# The per-account buckets do the real work. A campus NAT puts a whole university behind one
+# address, so the per-IP buckets only stop floods and must leave room for enrolment week.
+RATE_LIMIT_DEFAULTS = {
+    "login": {"ip": "300/60", "account": "5/60"},
+    "register": {"ip": "200/600", "account": "3/600"},
+    "verification_code": {"ip": "60/600", "account": "3/600"},
+}
+# Behind the Heroku router request.client is the router and the client address is the last
+# X-Forwarded-For entry. Heroku sets DYNO on every dyno, so the Procfile deployment trusts
+# the header by default; elsewhere enable it only when a proxy you control sets it.
+TRUST_PROXY_HEADERS = env_bool("TRUST_PROXY_HEADERS", "DYNO" in os.environ)
+
+def parse_rate_limit(rule: str):
+    """Parse "N/S" into (capacity, period_seconds); None disables the limit"""
+    if not rule or rule.strip() == "0":
+        return None
+    capacity, _, period = rule.partition("/")
+    return int(capacity), float(period or 60)
+
+def rate_limit_rule(route: str, scope: str):
+    return parse_rate_limit(os.getenv(f"RATE_LIMIT_{route.upper()}_{scope.upper()}") or RATE_LIMIT_DEFAULTS[route][scope])
+
+class MemoryRateLimitStore:
+    """Buckets in an in-process LRU; each worker enforces the limits on its own"""
+
+    def __init__(self, max_entries=50000):
+        self.cache = TTLCache(3600, max_entries)
+
+    async def take(self, key, capacity, period):
+        """Consume one token; returns 0 when allowed, otherwise seconds until a token is available"""
+        now = time.time()
+        rate = capacity / period
+        tokens, updated_at = self.cache.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * rate)
+        if tokens < 1:
+            return (1 - tokens) / rate
+        self.cache.set(key, (tokens - 1, now), ttl=period)
+        return 0
+
+class DatabaseRateLimitStore:
+    """rate_limit_buckets table, so every worker draws from the same buckets"""
+
+    async def take(self, key, capacity, period):
+        now = time.time()
+        rate = capacity / period
+        refilled = RateLimitBucket.tokens + (now - RateLimitBucket.updated_at) * rate
+        available = case((refilled > capacity, capacity), else_=refilled)
+        async with AsyncSessionLocal() as db:
+            # Refill and consume in one conditional UPDATE so concurrent workers cannot both
+            # spend the last token
+            result = await db.execute(
+                update(RateLimitBucket)
+                .where(RateLimitBucket.key == key, available >= 1)
+                .values(tokens=available - 1, updated_at=now, expires_at=now + period)
+            )
+            if result.rowcount:
+                await db.commit()
+                return 0
+            row = (await db.execute(
+                select(RateLimitBucket.tokens, RateLimitBucket.updated_at).where(RateLimitBucket.key == key)
+            )).first()
+            if row is not None:
+                return (1 - min(capacity, row.tokens + (now - row.updated_at) * rate)) / rate
+            # First request for this key: expired buckets are purged here, using the expires_at index
+            await db.execute(delete(RateLimitBucket).where(RateLimitBucket.expires_at < now))
+            db.add(RateLimitBucket(key=key, tokens=capacity - 1, updated_at=now, expires_at=now + period))
+            try:
+                await db.commit()
+                return 0
+            except IntegrityError:
+                # Another worker created the bucket at the same moment: draw from it instead
+                await db.rollback()
+        return await self.take(key, capacity, period)
+
+RATE_LIMIT_STORES = {"database": DatabaseRateLimitStore, "memory": MemoryRateLimitStore}
+RATE_LIMIT_STORE = (os.getenv("RATE_LIMIT_STORE") or "database").lower()
+if RATE_LIMIT_STORE not in RATE_LIMIT_STORES:
+    raise ValueError(f"Unknown RATE_LIMIT_STORE {RATE_LIMIT_STORE!r}, expected one of {sorted(RATE_LIMIT_STORES)}")
+rate_limit_store = RATE_LIMIT_STORES[RATE_LIMIT_STORE]()
+
+class RateLimitExceeded(HTTPException):
+    def __init__(self, retry_after: float):
+        super().__init__(
+            status_code=429,
+            detail="Trop de tentatives. Veuillez réessayer plus tard.",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+
+@app.exception_handler(RateLimitExceeded)
+async def rate_limit_exceeded_handler(request: Request, exc: RateLimitExceeded):
+    # The verification code button reads data.message from JSON; form posts get a plain page
+    if "text/html" in request.headers.get("accept", ""):
+        return HTMLResponse(f"<p>{exc.detail}</p>", status_code=exc.status_code, headers=exc.headers)
+    return JSONResponse({"success": False, "message": exc.detail}, status_code=exc.status_code, headers=exc.headers)
+
+def client_ip(request: Request) -> str:
+    if TRUST_PROXY_HEADERS and request.headers.get("x-forwarded-for"):
+        return request.headers["x-forwarded-for"].split(",")[-1].strip()
+    return request.client.host if request.client else "unknown"
+
+def rate_limited(route: str, account_field: str):
+    """Dependency factory enforcing the route's per-IP and per-account token buckets"""
+    ip_rule = rate_limit_rule(route, "ip")
+    account_rule = rate_limit_rule(route, "account")
+
+    async def check_rate_limit(request: Request):
+        # FastAPI has already parsed the form for the endpoint, so this reads the cached copy
+        account = str((await request.form()).get(account_field) or "").strip().lower()
+        buckets = [(f"{route}:ip:{client_ip(request)}", ip_rule)]
+        if account:
+            buckets.append((f"{route}:account:{account}", account_rule))
+        for key, rule in buckets:
+            if rule is None:
+                continue
+            retry_after = await rate_limit_store.take(key, *rule)
+            if retry_after > 0:
+                print(f"RATE LIMIT: {key} blocked for {retry_after:.0f}s")
+                raise RateLimitExceeded(retry_after)
+
+    return check_rate_limit
+
+# Verification codes
+# Professor registration codes live in the verification_codes table so the worker that
+# handles the register POST sees the code sent by any other worker. Only an HMAC of the code
+# is stored; a code is consumed on success and dropped after VERIFICATION_CODE_MAX_ATTEMPTS
+# wrong guesses.
+VERIFICATION_CODE_TTL = env_int("VERIFICATION_CODE_TTL", 600)
+VERIFICATION_CODE_MAX_ATTEMPTS = env_int("VERIFICATION_CODE_MAX_ATTEMPTS", 5)
+
+def hash_verification_code(email: str, code: str) -> str:
+    return hmac.new(SECRET_KEY.encode(), f"{email}:{code}".encode(), hashlib.sha256).hexdigest()
+
+async def store_verification_code(email: str, code: str):
+    now = datetime.utcnow()
+    async with AsyncSessionLocal() as db:
+        await db.execute(delete(VerificationCode).where(
+            or_(VerificationCode.email == email, VerificationCode.expires_at < now)
+        ))
+        db.add(VerificationCode(
+            email=email, code_hash=hash_verification_code(email, code), attempts=0,
+            created_at=now, expires_at=now + timedelta(seconds=VERIFICATION_CODE_TTL),
+        ))
+        await db.commit()
+
+async def check_verification_code(email: str, code: str):
+    """Consume the code sent to email; returns one of "ok", "invalid", "expired" """
+    async with AsyncSessionLocal() as db:
+        row = (await db.execute(
+            select(VerificationCode.code_hash, VerificationCode.attempts, VerificationCode.expires_at)
+            .where(VerificationCode.email == email)
+        )).first()
+        if row is None:
+            return "invalid"
+        if row.expires_at < datetime.utcnow():
+            await db.execute(delete(VerificationCode).where(VerificationCode.email == email))
+            await db.commit()
+            return "expired"
+        if row.attempts >= VERIFICATION_CODE_MAX_ATTEMPTS or not hmac.compare_digest(row.code_hash, hash_verification_code(email, code)):
+            if row.attempts + 1 >= VERIFICATION_CODE_MAX_ATTEMPTS:
+                await db.execute(delete(VerificationCode).where(VerificationCode.email == email))
+            else:
+                await db.execute(
+                    update(VerificationCode).where(VerificationCode.email == email)
+                    .values(attempts=VerificationCode.attempts + 1)
+                )
+            await db.commit()
+            return "invalid"
+        # Deleting by hash makes the code single-use even if two requests race with it
+        result = await db.execute(delete(VerificationCode).where(
+            VerificationCode.email == email, VerificationCode.code_hash == row.code_hash
+        ))
+        await db.commit()
+        return "ok" if result.rowcount else "invalid"
+
+# Periodic purge of expired sessions, verification codes, rate limit buckets and delivered
+# outbox emails, so tables only hold live rows even when nobody logs in or registers for a while
+MAINTENANCE_INTERVAL = env_int("MAINTENANCE_INTERVAL", 600)
+
+async def purge_expired_rows():
+    now = datetime.utcnow()
+    async with AsyncSessionLocal() as db:
+        await db.execute(delete(UserSession).where(UserSession.expires_at < now))
+        await db.execute(delete(VerificationCode).where(VerificationCode.expires_at < now))
+        await db.execute(delete(RateLimitBucket).where(RateLimitBucket.expires_at < time.time()))
+        # Sent rows are the sending governor's usage history, keep at least a day of them
+        await db.execute(delete(EmailOutbox).where(
+            EmailOutbox.status == "sent", EmailOutbox.sent_at < now - timedelta(days=max(1, EMAIL_OUTBOX_RETENTION_DAYS))
+        ))
+        # Dead letters are kept for inspection, but not the codes of dead verification emails
+        await db.execute(update(EmailOutbox).where(
+            EmailOutbox.status == "dead", EmailOutbox.email_type == "verification_code", EmailOutbox.body != ""
+        ).values(body=""))
+        await db.commit()
+
+async def run_maintenance():
+    while True:
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+        try:
+            await purge_expired_rows()
+        except Exception as e:
+            print(f"MAINTENANCE: purge of expired rows failed: {e}")
+
+@app.on_event("startup")
+async def start_maintenance():
+    app.state.maintenance_task = asyncio.create_task(run_maintenance())
+
+@app.on_event("shutdown")
+async def stop_maintenance():
+    app.state.maintenance_task.cancel()
+
+# Logged-in user resolution
+# current_user resolves the session's user once per request into request.state.user, as a
+# lightweight CurrentUser record (no password hash) cached per process for USER_CACHE_TTL
+# seconds. Changes to the cached fields must call invalidate_cached_user(); other workers
+# pick them up when their entry expires.
+@dataclass(frozen=True)
+class CurrentUser:
+    id: int
+    username: str
+    role: str
+    approval_status: str
+    first_name: str
+    last_name: str
+    profile_image: str
+
+USER_CACHE_TTL = env_int("USER_CACHE_TTL", 30)
+user_cache = TTLCache(USER_CACHE_TTL, max_entries=5000)
+
+def invalidate_cached_user(user_id: int):
+    user_cache.pop(user_id)
+
+async def load_current_user(user_id: int):
+    user = user_cache.get(user_id)
+    if user is None:
+        async with ReadSessionLocal() as db:
+            row = (await db.execute(
+                select(User.id, User.username, User.role, User.approval_status, User.first_name, User.last_name, User.profile_image)
+                .where(User.id == user_id)
+            )).first()
+        if row is None:
+            return None
+        user = CurrentUser(**row._mapping)
+        user_cache.set(user_id, user)
+    return user
+
+async def current_user(request: Request, user_id: int = Depends(get_session_user_id)):
+    """Dependency returning the logged-in CurrentUser, or None"""
+    if not hasattr(request.state, "user"):
+        request.state.user = await load_current_user(user_id) if user_id else None
+    return request.state.user
+
+# Project access control
+# A user's standing on a project (manager, team member, admin/professor) comes from one query,
+# memoized per request in request.state and per process for PROJECT_ACCESS_CACHE_TTL seconds.
+# Membership changes must call invalidate_project_access(); other workers pick them up when
+# their entry expires.
+@dataclass(frozen=True)
+class ProjectAccess:
+    exists: bool
+    is_manager: bool
+    is_team_member: bool
+    is_admin_or_prof: bool
+
+    @property
+    def can_view(self):
+        """Open the project page, upload and download files, post messages"""
+        return self.exists and (self.is_manager or self.is_team_member or self.is_admin_or_prof)
+
+    @property
+    def can_manage(self):
+        """Change progress and members"""
+        return self.exists and (self.is_manager or self.is_admin_or_prof)
+
+PROJECT_ACCESS_CACHE_TTL = env_int("PROJECT_ACCESS_CACHE_TTL", 30)
+project_access_cache = TTLCache(PROJECT_ACCESS_CACHE_TTL, max_entries=20000)
+
+def invalidate_project_access(project_id: int, user_id: int = None):
+    """Drop cached access for one member of a project, or for everyone when user_id is None"""
+    if user_id is not None:
+        project_access_cache.pop((user_id, project_id))
+        return
+    for key in [key for key in project_access_cache.entries if key[1] == project_id]:
+        project_access_cache.pop(key)
+
+async def resolve_project_access(request: Request, user: CurrentUser, project_id: int) -> ProjectAccess:
+    if not hasattr(request.state, "project_access"):
+        request.state.project_access = {}
+    memo = request.state.project_access
+    if project_id not in memo:
+        key = (user.id, project_id)
+        cached = project_access_cache.get(key)
+        if cached is None:
+            # Access decisions read the primary so a removed member loses access immediately
+            async with AsyncSessionLocal() as db:
+                row = (await db.execute(
+                    select(
+                        Project.manager_id,
+                        exists().where(TeamMember.project_id == project_id, TeamMember.user_id == user.id).label("is_member"),
+                    ).where(Project.id == project_id)
+                )).first()
+            cached = (row is not None, row is not None and row.manager_id == user.id, row is not None and bool(row.is_member))
+            project_access_cache.set(key, cached)
+        exists_, is_manager, is_team_member = cached
+        memo[project_id] = ProjectAccess(exists_, is_manager, is_team_member, user.role in ['Admin', 'Professor'])
+    return memo[project_id]
+
+def require_prof_or_admin(user: CurrentUser):
     return user and user.role in ["Professor", "Admin"]
 
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
     return templates.TemplateResponse("Login.html", {"request": request})
 
-@app.post("/login")
-async def login(username: str = Form(...), password: str = Form(...), db: Session = Depends(get_db)):
-    global current_user_id
-    user = db.query(User).filter(User.username == username).first()
-    if user and pwd_context.verify(password, user.hashed_password):
+@app.post("/login", dependencies=[Depends(rate_limited("login", "username"))])
+async def login(username: str = Form(...), password: str = Form(...), db: AsyncSession = Depends(get_async_db)):
+    user = await db.scalar(select(User).where(User.username == username))
+    valid, new_hash = await verify_password(password, user.hashed_password) if user else (False, None)
+    if valid:
+        if new_hash:
+            # Stored hash uses outdated parameters: upgrade it now that we know the password
+            user.hashed_password = new_hash
+            await db.commit()
         # Block login for students not yet approved
         if user.role.lower() == "student":
             if user.approval_status == "pending":
                 return RedirectResponse(url="/?error=pending", status_code=303)
             if user.approval_status == "rejected":
                 return RedirectResponse(url="/?error=rejected", status_code=303)
-        current_user_id = user.id
-        return RedirectResponse(url="/dashboard", status_code=303)
+        response = RedirectResponse(url="/dashboard", status_code=303)
+        await start_session(response, user.id)
+        return response
     return RedirectResponse(url="/?error=1", status_code=303)
 
 @app.get("/register", response_class=HTMLResponse)
 async def register_page(request: Request):
     return templates.TemplateResponse("register.html", {"request": request})
 
-@app.post("/register")
+@app.post("/register", dependencies=[Depends(rate_limited("register", "email"))])
 async def register(
     first_name: str = Form(default=None),
     last_name: str = Form(default=None),
@@ -721,21 +2016,10 @@ async def register(
         if not verification_code:
             return RedirectResponse(url="/register?error=missing_verification_code", status_code=303)
 
-        # Verify the code (this would normally check against a stored code)
-        # For now, we'll use a simple session-based approach
-        stored_code = current_user_verification_codes.get(email, {}).get('code')
-        code_timestamp = current_user_verification_codes.get(email, {}).get('timestamp')
-
-        if not stored_code or stored_code != verification_code:
-            return RedirectResponse(url="/register?error=invalid_verification_code", status_code=303)
-
-        # Check if code is expired (10 minutes)
-        if code_timestamp and (datetime.utcnow() - code_timestamp).seconds > 600:
-            return RedirectResponse(url="/register?error=expired_verification_code", status_code=303)
-
-        # Clear the used code
-        if email in current_user_verification_codes:
-            del current_user_verification_codes[email]
+        # Verify and consume the code sent by /send-verification-code
+        code_status = await check_verification_code(email, verification_code.strip())
+        if code_status != "ok":
+            return RedirectResponse(url=f"/register?error={code_status}_verification_code", status_code=303)
 
     # Check duplicates early to avoid IntegrityError
     existing_username = db.query(User).filter(User.username == username).first()
@@ -780,7 +2064,7 @@ async def register(
         except ValueError:
             birth_date_value = None
 
-    hashed_password = pwd_context.hash(password)
+    hashed_password = await hash_password(password)
     user = User(
         first_name=first_name,
         last_name=last_name,
@@ -796,6 +2080,8 @@ async def register(
         student_card_image=card_path if is_student else None,
         specialty=specialty,
         approval_status="pending" if is_student else "approved",
+        # In digest mode the next summary picks the registration up and sets this
+        registration_notified_at=datetime.utcnow() if is_student and PROFESSOR_NOTIFICATIONS == "immediate" else None,
     )
     db.add(user)
     try:
@@ -804,25 +2090,26 @@ async def register(
         db.rollback()
         return RedirectResponse(url="/register?error=duplicate", status_code=303)
 
-    # Notify professors of new student registration
+    # Notify professors of new student registration (in digest mode they get a periodic summary instead)
     if is_student:
-        profs = db.query(User).filter(User.role == "Professor").all()
-        prof_emails = [p.email for p in profs if p.email]
-        student_info = [
-            f"Nom: {first_name} {last_name}",
-            f"Nom d'utilisateur: {username}",
-            f"Email: {email}",
-            f"Numéro de téléphone: {phone_number or 'Non spécifié'}",
-            f"Genre: {gender}",
-            f"Numéro de carte d'étudiant: {student_id_number}",
-            f"Lieu de naissance: {birth_place}",
-            f"Date de naissance: {birth_date}",
-            f"Chemin de l'image de la carte: {card_path or 'Non attachée'}",
-        ]
-        # Get base URL from environment or use default
-        base_url = os.getenv("BASE_URL", "http://localhost:8000")
-        body = "Nouvelle demande d'inscription d'étudiant:\n" + "\n".join(student_info) + f"\n\nPour approuver: {base_url}/students/{user.id}/approve\nPour refuser: {base_url}/students/{user.id}/reject"
-        send_email(prof_emails, "Nouvelle demande d'inscription d'étudiant", body, attachments=[card_path] if card_path else None, email_type="notification")
+        if PROFESSOR_NOTIFICATIONS == "immediate":
+            profs = db.query(User).filter(User.role == "Professor").all()
+            prof_emails = [p.email for p in profs if p.email]
+            student_info = [
+                f"Nom: {first_name} {last_name}",
+                f"Nom d'utilisateur: {username}",
+                f"Email: {email}",
+                f"Numéro de téléphone: {phone_number or 'Non spécifié'}",
+                f"Genre: {gender}",
+                f"Numéro de carte d'étudiant: {student_id_number}",
+                f"Lieu de naissance: {birth_place}",
+                f"Date de naissance: {birth_date}",
+                f"Chemin de l'image de la carte: {card_path or 'Non attachée'}",
+            ]
+            # Get base URL from environment or use default
+            base_url = os.getenv("BASE_URL", "http://localhost:8000")
+            body = "Nouvelle demande d'inscription d'étudiant:\n" + "\n".join(student_info) + f"\n\nPour approuver: {base_url}/students/{user.id}/approve\nPour refuser: {base_url}/students/{user.id}/reject"
+            await send_email(prof_emails, "Nouvelle demande d'inscription d'étudiant", body, attachments=[card_path] if card_path else None, email_type="notification", priority=EMAIL_PRIORITY_LOW)
 
         # Send confirmation email to student
         if email:
@@ -840,7 +2127,7 @@ Merci de rejoindre notre communauté scientifique !
 
 Cordialement,
 L'équipe INTERSTELLAR CLUB"""
-            send_email(email, "Confirmation de votre demande d'inscription - INTERSTELLAR CLUB", confirmation_body, email_type="confirmation")
+            await send_email(email, "Confirmation de votre demande d'inscription - INTERSTELLAR CLUB", confirmation_body, email_type="confirmation")
     else:
         # Welcome email for professor
         if email:
@@ -863,21 +2150,22 @@ Bienvenue dans notre équipe éducative !
 
 Cordialement,
 L'équipe INTERSTELLAR CLUB"""
-            send_email(email, "🎓 Vous avez été enregistré en tant que professeur - INTERSTELLAR CLUB", professor_welcome_body, email_type="welcome")
+            await send_email(email, "🎓 Vous avez été enregistré en tant que professeur - INTERSTELLAR CLUB", professor_welcome_body, email_type="welcome")
 
     return RedirectResponse(url="/", status_code=303)
 
 @app.get("/club-card")
-async def club_card(request: Request, db: Session = Depends(get_db)):
-    if not current_user_id:
+async def club_card(request: Request, user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_read_db)):
+    if not user:
         return RedirectResponse(url="/", status_code=303)
 
-    user = get_current_user(db)
-
     # Only approved students can see their club card
     if user.role.lower() != "student" or user.approval_status != "approved":
         return RedirectResponse(url="/dashboard", status_code=303)
 
+    # The card prints profile details that are not part of the cached CurrentUser
+    user = await db.get(User, user.id)
+
     # Generate card number (format: YYYY + random 4 digits)
     current_year = datetime.utcnow().year
     card_number = f"{current_year}{user.id:04d}"
@@ -892,10 +2180,10 @@ async def club_card(request: Request, db: Session = Depends(get_db)):
         "academic_year": academic_year
     })
 
-@app.post("/send-verification-code")
+@app.post("/send-verification-code", dependencies=[Depends(rate_limited("verification_code", "email"))])
 async def send_verification_code(email: str = Form(...)):
     """Send verification code to professor email"""
-    import random
+    email = (email or "").strip().lower()
 
     # Send email
     try:
@@ -904,165 +2192,16 @@ async def send_verification_code(email: str = Form(...)):
             return {"success": False, "message": "Adresse email universitaire invalide"}
 
         # Generate 6-digit code
-        verification_code = str(random.randint(100000, 999999))
+        verification_code = str(secrets.randbelow(900000) + 100000)
 
-        # Store code with timestamp
-        current_user_verification_codes[email] = {
-            'code': verification_code,
-            'timestamp': datetime.utcnow()
-        }
-
-        subject = "Code de vérification - INTERSTELLAR CLUB"
-
-        # HTML body with embedded logos - Professional Design for verification code
-        html_body = f"""
-    <!DOCTYPE html>
-    <html lang="fr">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>Code de vérification - INTERSTELLAR CLUB</title>
-    </head>
-    <body style="margin: 0; padding: 0; font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; background: linear-gradient(135deg, #0f172a 0%, #1e293b 100%); min-height: 100vh;">
-        <table width="100%" border="0" cellspacing="0" cellpadding="0" style="background: linear-gradient(135deg, #0f172a 0%, #1e293b 100%);">
-            <tr>
-                <td align="center" style="padding: 40px 20px;">
-                    <table width="600" border="0" cellspacing="0" cellpadding="0" style="background: rgba(255,255,255,0.95); border-radius: 16px; box-shadow: 0 20px 40px rgba(0,0,0,0.3); overflow: hidden;">
-                        <!-- Header with logos -->
-                        <tr>
-                            <td style="background: linear-gradient(135deg, #06b6d4 0%, #4f46e5 100%); padding: 30px 20px; text-align: center;">
-                                <table width="100%" border="0" cellspacing="0" cellpadding="0">
-                                    <tr>
-                                        <td align="center">
-                                            <img src="cid:logo_main" alt="INTERSTELLAR CLUB" style="height: 70px; margin: 0 15px; border-radius: 8px; box-shadow: 0 4px 8px rgba(0,0,0,0.2);">
-                                            <img src="cid:logo_secondary" alt="Second Logo" style="height: 55px; margin: 0 15px; border-radius: 6px; box-shadow: 0 4px 8px rgba(0,0,0,0.2);">
-                                        </td>
-                                    </tr>
-                                    <tr>
-                                        <td align="center" style="padding-top: 15px;">
-                                            <h1 style="color: white; margin: 0; font-size: 28px; font-weight: 700; text-shadow: 0 2px 4px rgba(0,0,0,0.3);">
-                                                INTERSTELLAR CLUB
-                                            </h1>
-                                            <p style="color: rgba(255,255,255,0.9); margin: 5px 0 0 0; font-size: 16px; font-weight: 300;">
-                                                Code de vérification
-                                            </p>
-                                        </td>
-                                    </tr>
-                                </table>
-                            </td>
-                        </tr>
-
-                        <!-- Main content -->
-                        <tr>
-                            <td style="padding: 40px 30px;">
-                                <table width="100%" border="0" cellspacing="0" cellpadding="0">
-                                    <tr>
-                                        <td style="color: #1f2937; font-size: 16px; line-height: 1.8; text-align: center;">
-                                            <h2 style="color: #06b6d4; margin-bottom: 20px;">🔐 Code de vérification</h2>
-                                            <p style="margin-bottom: 30px;">Bonjour,</p>
-                                            <p>Votre code de vérification pour l'inscription à <strong>INTERSTELLAR CLUB</strong> est :</p>
-
-                                            <!-- Verification Code Box -->
-                                            <table width="100%" border="0" cellspacing="0" cellpadding="0" style="margin: 30px 0;">
-                                                <tr>
-                                                    <td align="center">
-                                                        <div style="background: linear-gradient(135deg, #06b6d4 0%, #4f46e5 100%); color: white; padding: 20px; border-radius: 12px; font-size: 32px; font-weight: bold; letter-spacing: 8px; box-shadow: 0 8px 20px rgba(6, 182, 212, 0.3);">
-                                                            {verification_code}
-                                                        </div>
-                                                    </td>
-                                                </tr>
-                                            </table>
-
-                                            <p style="color: #64748b; font-size: 14px; margin-top: 20px;">
-                                                ⏰ <strong>Ce code est valable pendant 10 minutes.</strong>
-                                            </p>
-                                            <p style="color: #64748b; font-size: 14px;">
-                                                Veuillez entrer ce code dans le formulaire d'inscription pour compléter votre enregistrement.
-                                            </p>
-                                        </td>
-                                    </tr>
-                                </table>
-                            </td>
-                        </tr>
-
-                        <!-- Footer -->
-                        <tr>
-                            <td style="background: #f8fafc; padding: 30px; border-top: 2px solid #e2e8f0;">
-                                <table width="100%" border="0" cellspacing="0" cellpadding="0">
-                                    <tr>
-                                        <td align="center" style="color: #64748b; font-size: 14px; line-height: 1.6;">
-                                            <p style="margin: 0 0 10px 0;">
-                                                <strong style="color: #06b6d4;">INTERSTELLAR CLUB</strong><br>
-                                                Club Universitaire d'Innovation Scientifique
-                                            </p>
-                                            <p style="margin: 0; font-size: 12px; color: #94a3b8;">
-                                                Cet email a été envoyé automatiquement depuis notre plateforme.<br>
-                                                Pour toute question, contactez-nous à l'adresse universitaire.
-                                            </p>
-                                        </td>
-                                    </tr>
-                                    <tr>
-                                        <td align="center" style="padding-top: 20px;">
-                                            <div style="display: inline-block; padding: 12px 24px; background: linear-gradient(135deg, #06b6d4 0%, #4f46e5 100%); color: white; text-decoration: none; border-radius: 8px; font-weight: 600; box-shadow: 0 4px 12px rgba(6, 182, 212, 0.3);">
-                                                🌟 Explorez l'Innovation Scientifique
-                                            </div>
-                                        </td>
-                                    </tr>
-                                </table>
-                            </td>
-                        </tr>
-                    </table>
-
-                    <!-- Disclaimer -->
-                    <table width="600" border="0" cellspacing="0" cellpadding="0" style="margin-top: 20px;">
-                        <tr>
-                            <td align="center" style="color: rgba(255,255,255,0.7); font-size: 11px; line-height: 1.4;">
-                                <p style="margin: 0;">
-                                    🔒 Cet email contient des informations confidentielles.<br>
-                                    INTERSTELLAR CLUB - Tous droits réservés © 2025
-                                </p>
-                            </td>
-                        </tr>
-                    </table>
-                </td>
-            </tr>
-        </table>
-    </body>
-    </html>
-    """
-
-        # Send HTML email
-        # Create HTML email with embedded logos
-        msg = MIMEMultipart("related")
-        msg["From"] = EMAIL_FROM
-        msg["To"] = email
-        msg["Subject"] = subject
-
-        # Attach HTML content
-        html_part = MIMEText(html_body, "html", "utf-8")
-        msg.attach(html_part)
-
-        # Attach logos as inline images
-        logo_paths = ["static/logo.png", "static/logo1.png"]
-        logo_cids = ["logo_main", "logo_secondary"]
-
-        for i, logo_path in enumerate(logo_paths):
-            try:
-                if os.path.exists(logo_path):
-                    with open(logo_path, "rb") as f:
-                        logo_part = MIMEImage(f.read())
-                        logo_part.add_header('Content-ID', f'<{logo_cids[i]}>')
-                        logo_part.add_header('Content-Disposition', 'inline')
-                        msg.attach(logo_part)
-            except Exception as e:
-                print(f"Logo attachment failed ({logo_path}):", e)
+        # Store code (hashed) with its expiry
+        await store_verification_code(email, verification_code)
 
-        # Send via Gmail
-        server = smtplib.SMTP(EMAIL_HOST, EMAIL_PORT, timeout=10)
-        server.starttls()
-        server.login(EMAIL_USER, EMAIL_PASS)
-        server.sendmail(EMAIL_FROM, email, msg.as_string())
-        server.quit()
+        # Queued ahead of other mail, rendered with the verification code template
+        await send_email(
+            email, "Code de vérification - INTERSTELLAR CLUB", verification_code,
+            email_type="verification_code", priority=EMAIL_PRIORITY_HIGH,
+        )
 
         return {"success": True, "message": "Code envoyé avec succès"}
 
@@ -1071,53 +2210,68 @@ async def send_verification_code(email: str = Form(...)):
         return {"success": False, "message": "Erreur lors de l'envoi du code"}
 
 @app.get("/dashboard", response_class=HTMLResponse)
-async def dashboard(request: Request, db: Session = Depends(get_db)):
-    if not current_user_id:
+async def dashboard(request: Request, user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_read_db)):
+    if not user:
         return RedirectResponse(url="/", status_code=303)
     
-    user = get_current_user(db)
-    
     # Get all projects count for statistics (exclude the general team members project)
-    total_projects_count = db.query(Project).filter(Project.name != "Membres d'équipe").count()
+    total_projects_count = await db.scalar(select(func.count(Project.id)).where(Project.is_system == false()))
 
-    # Get projects based on role (exclude the general team members project)
-    if user.role in ['Admin', 'Professor']:
-        projects = db.query(Project).filter(Project.name != "Membres d'équipe").all()
-    else:
-        managed_projects = db.query(Project).filter(Project.manager_id == user.id, Project.name != "Membres d'équipe").all()
-        team_projects_ids = [tm.project_id for tm in db.query(TeamMember).filter(TeamMember.user_id == user.id).all()]
-        team_projects = db.query(Project).filter(Project.id.in_(team_projects_ids), Project.name != "Membres d'équipe").all() if team_projects_ids else []
-        projects = list({p.id: p for p in (managed_projects + team_projects)}.values())
+    # Get projects based on role (exclude the general team members project); only the
+    # columns the project cards show are fetched
+    project_query = select(
+        Project.id, Project.name, Project.type, Project.mission_objective, Project.status, Project.overall_progress
+    ).where(Project.is_system == false())
+    if user.role not in ['Admin', 'Professor']:
+        member_of = select(TeamMember.project_id).where(TeamMember.user_id == user.id)
+        project_query = project_query.where(or_(Project.manager_id == user.id, Project.id.in_(member_of)))
+    projects = (await db.execute(project_query)).all()
 
     pending_students = []
     approved_students = []
     rejected_students = []
-    approver_map = {}
     team_members = []
-    total_team_members = 0
 
-    # Get approved students for all users (to show team members count and section)
-    approved_students = db.query(User).filter(User.role == "Student", User.approval_status == "approved").order_by(User.approval_decision_at.desc().nullslast()).all()
-    total_team_members = len(approved_students)
+    # Team member cards: member, project name and user name in a single joined query
+    team_member_query = (
+        select(
+            TeamMember.role, TeamMember.responsibilities, TeamMember.added_at,
+            Project.name.label("project_name"), User.first_name, User.last_name,
+        )
+        .join(Project, TeamMember.project_id == Project.id)
+        .join(User, TeamMember.user_id == User.id)
+    )
 
     if user.role in ['Admin', 'Professor']:
-        pending_students = db.query(User).filter(User.role == "Student", User.approval_status == "pending").all()
-        rejected_students = db.query(User).filter(User.role == "Student", User.approval_status == "rejected").order_by(User.approval_decision_at.desc().nullslast()).all()
-        approver_ids = {s.approval_by_id for s in approved_students + rejected_students if s.approval_by_id}
-        if approver_ids:
-            approver_map = {u.id: u for u in db.query(User).filter(User.id.in_(approver_ids)).all()}
+        # All student requests in one query, with the approver's name joined in
+        approver = aliased(User)
+        students = (await db.execute(
+            select(
+                User.id, User.username, User.first_name, User.last_name, User.email,
+                User.student_id_number, User.birth_place, User.birth_date, User.created_at,
+                User.approval_status, User.approval_decision_at,
+                approver.username.label("approver_username"),
+                approver.first_name.label("approver_first_name"),
+                approver.last_name.label("approver_last_name"),
+            )
+            .outerjoin(approver, User.approval_by_id == approver.id)
+            .where(User.role == "Student", User.approval_status.in_(["pending", "approved", "rejected"]))
+            .order_by(User.approval_decision_at.desc().nullslast())
+        )).all()
+        pending_students = [s for s in students if s.approval_status == "pending"]
+        approved_students = [s for s in students if s.approval_status == "approved"]
+        rejected_students = [s for s in students if s.approval_status == "rejected"]
+        total_team_members = len(approved_students)
         # Get all team members with their project info (excluding the general team members project)
-        team_members = db.query(TeamMember).join(Project).filter(Project.name != "Membres d'équipe").all()
+        team_members = (await db.execute(team_member_query.where(Project.is_system == false()))).all()
     else:
+        total_team_members = await db.scalar(
+            select(func.count(User.id)).where(User.role == "Student", User.approval_status == "approved")
+        )
         # Limit team list to projects the user manages or belongs to
         project_ids = [p.id for p in projects]
         if project_ids:
-            team_members = (
-                db.query(TeamMember)
-                .join(Project)
-                .filter(TeamMember.project_id.in_(project_ids))
-                .all()
-            )
+            team_members = (await db.execute(team_member_query.where(TeamMember.project_id.in_(project_ids)))).all()
     
     return templates.TemplateResponse("dashboard.html", {
         "request": request,
@@ -1127,17 +2281,15 @@ async def dashboard(request: Request, db: Session = Depends(get_db)):
         "pending_students": pending_students,
         "approved_students": approved_students,
         "rejected_students": rejected_students,
-        "approver_map": approver_map,
         "team_members": team_members,
         "total_team_members": total_team_members
     })
 
 @app.get("/projects/new", response_class=HTMLResponse)
-async def new_project_page(request: Request, db: Session = Depends(get_db)):
-    if not current_user_id:
+async def new_project_page(request: Request, user: CurrentUser = Depends(current_user)):
+    if not user:
         return RedirectResponse(url="/", status_code=303)
     
-    user = get_current_user(db)
     return templates.TemplateResponse("new_project.html", {"request": request, "user": user})
 
 @app.post("/projects/new")
@@ -1148,9 +2300,10 @@ async def create_project(
     success_criteria: str = Form(...),
     start_date: str = Form(...),
     end_date: str = Form(...),
+    user: CurrentUser = Depends(current_user),
     db: Session = Depends(get_db)
 ):
-    if not current_user_id:
+    if not user:
         return RedirectResponse(url="/", status_code=303)
     
     project = Project(
@@ -1158,7 +2311,7 @@ async def create_project(
         type=type,
         mission_objective=mission_objective,
         success_criteria=success_criteria,
-        manager_id=current_user_id,
+        manager_id=user.id,
         start_date=datetime.fromisoformat(start_date),
         end_date=datetime.fromisoformat(end_date)
     )
@@ -1175,38 +2328,52 @@ async def create_project(
     return RedirectResponse(url=f"/projects/{project.id}", status_code=303)
 
 @app.get("/projects/{project_id}", response_class=HTMLResponse)
-async def project_detail(request: Request, project_id: int, db: Session = Depends(get_db)):
-    if not current_user_id:
+async def project_detail(request: Request, project_id: int, user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_read_db)):
+    if not user:
         return RedirectResponse(url="/", status_code=303)
     
-    user = get_current_user(db)
-    project = db.query(Project).filter(Project.id == project_id).first()
+    access = await resolve_project_access(request, user, project_id)
+    if not access.exists:
+        raise HTTPException(status_code=404, detail="Project not found")
+    if not access.can_view:
+        return RedirectResponse(url="/dashboard", status_code=303)
     
+    project = await db.get(Project, project_id)
     if not project:
         raise HTTPException(status_code=404, detail="Project not found")
     
-    # Check if user has access to this project
-    is_manager = project.manager_id == user.id
-    is_team_member = db.query(TeamMember).filter(
-        TeamMember.project_id == project_id,
-        TeamMember.user_id == user.id
-    ).first() is not None
-    is_admin_or_prof = user.role in ['Admin', 'Professor']
-    
-    if not (is_manager or is_team_member or is_admin_or_prof):
-        return RedirectResponse(url="/dashboard", status_code=303)
-    
-    phases = db.query(Phase).filter(Phase.project_id == project_id).all()
-    risks = db.query(Risk).filter(Risk.project_id == project_id).all()
-    team_members = db.query(TeamMember).filter(TeamMember.project_id == project_id).all()
-    files = db.query(ProjectFile).filter(ProjectFile.project_id == project_id).order_by(ProjectFile.uploaded_at.desc()).all()
-    messages = db.query(Message).filter(Message.project_id == project_id).order_by(Message.created_at.asc()).all()
+    # Loading strategy: project.html walks member.user, file.uploader and message.user, so
+    # each list is one SELECT plus one selectin IN-query for its users, restricted to the
+    # columns the template prints. The query count does not grow with the number of rows.
+    phases = (await db.scalars(select(Phase).where(Phase.project_id == project_id))).all()
+    risks = (await db.scalars(select(Risk).where(Risk.project_id == project_id))).all()
+    team_members = (await db.scalars(
+        select(TeamMember)
+        .where(TeamMember.project_id == project_id)
+        .options(selectinload(TeamMember.user).load_only(User.first_name, User.last_name))
+    )).all()
+    files = (await db.scalars(
+        select(ProjectFile)
+        .where(ProjectFile.project_id == project_id)
+        .order_by(ProjectFile.uploaded_at.desc())
+        .options(selectinload(ProjectFile.uploader).load_only(User.username))
+    )).all()
+    messages = (await db.scalars(
+        select(Message)
+        .where(Message.project_id == project_id)
+        .order_by(Message.created_at.asc())
+        .options(selectinload(Message.user).load_only(User.first_name, User.last_name))
+    )).all()
     
     # Get all users for adding members
-    all_users = db.query(User).filter(
-        (User.role.in_(['Member', 'Project Manager'])) |
-        ((User.role == 'Student') & (User.approval_status == 'approved'))
-    ).all()
+    all_users = (await db.scalars(
+        select(User)
+        .where(
+            (User.role.in_(['Member', 'Project Manager'])) |
+            ((User.role == 'Student') & (User.approval_status == 'approved'))
+        )
+        .options(load_only(User.first_name, User.last_name))
+    )).all()
     team_user_ids = [tm.user_id for tm in team_members]
     available_users = [u for u in all_users if u.id not in team_user_ids and u.id != project.manager_id]
     
@@ -1220,25 +2387,27 @@ async def project_detail(request: Request, project_id: int, db: Session = Depend
         "files": files,
         "messages": messages,
         "available_users": available_users,
-        "is_manager": is_manager,
-        "is_admin_or_prof": is_admin_or_prof
+        "is_manager": access.is_manager,
+        "is_admin_or_prof": access.is_admin_or_prof
     })
 
 @app.post("/projects/{project_id}/add-member")
 async def add_team_member(
+    request: Request,
     project_id: int,
     user_id: int = Form(...),
     role: str = Form(...),
     responsibilities: str = Form(default=""),
+    user: CurrentUser = Depends(current_user),
     db: Session = Depends(get_db)
 ):
-    if not current_user_id:
+    if not user:
         return RedirectResponse(url="/", status_code=303)
     
-    user = get_current_user(db)
-    project = db.query(Project).filter(Project.id == project_id).first()
-    
-    if not (user.role in ['Admin', 'Professor'] or project.manager_id == user.id):
+    access = await resolve_project_access(request, user, project_id)
+    if not access.exists:
+        raise HTTPException(status_code=404, detail="Project not found")
+    if not access.can_manage:
         return RedirectResponse(url=f"/projects/{project_id}", status_code=303)
     
     team_member = TeamMember(
@@ -1248,47 +2417,56 @@ async def add_team_member(
         responsibilities=responsibilities
     )
     db.add(team_member)
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        # Already a member of this project
+        db.rollback()
+    invalidate_project_access(project_id, user_id)
     
     return RedirectResponse(url=f"/projects/{project_id}", status_code=303)
 
 @app.post("/projects/{project_id}/remove-member/{member_id}")
 async def remove_team_member(
+    request: Request,
     project_id: int,
     member_id: int,
+    user: CurrentUser = Depends(current_user),
     db: Session = Depends(get_db)
 ):
-    if not current_user_id:
+    if not user:
         return RedirectResponse(url="/", status_code=303)
     
-    user = get_current_user(db)
-    project = db.query(Project).filter(Project.id == project_id).first()
-    
-    if not (user.role in ['Admin', 'Professor'] or project.manager_id == user.id):
+    access = await resolve_project_access(request, user, project_id)
+    if not access.can_manage:
         return RedirectResponse(url=f"/projects/{project_id}", status_code=303)
     
-    member = db.query(TeamMember).filter(TeamMember.id == member_id).first()
+    member = db.query(TeamMember).filter(TeamMember.id == member_id, TeamMember.project_id == project_id).first()
     if member:
         db.delete(member)
         db.commit()
+        invalidate_project_access(project_id, member.user_id)
     
     return RedirectResponse(url=f"/projects/{project_id}", status_code=303)
 
 @app.post("/projects/{project_id}/update-progress")
 async def update_project_progress(
+    request: Request,
     project_id: int,
     overall_progress: int = Form(...),
+    user: CurrentUser = Depends(current_user),
     db: Session = Depends(get_db)
 ):
-    if not current_user_id:
+    if not user:
         return RedirectResponse(url="/", status_code=303)
     
-    user = get_current_user(db)
-    project = db.query(Project).filter(Project.id == project_id).first()
-    
-    if not (user.role in ['Admin', 'Professor'] or project.manager_id == user.id):
+    access = await resolve_project_access(request, user, project_id)
+    if not access.exists:
+        raise HTTPException(status_code=404, detail="Project not found")
+    if not access.can_manage:
         return RedirectResponse(url=f"/projects/{project_id}", status_code=303)
     
+    project = db.query(Project).filter(Project.id == project_id).first()
     project.overall_progress = overall_progress
     db.commit()
     
@@ -1296,22 +2474,22 @@ async def update_project_progress(
 
 @app.post("/members/{member_id}/update-progress")
 async def update_member_progress(
+    request: Request,
     member_id: int,
     progress: int = Form(...),
+    user: CurrentUser = Depends(current_user),
     db: Session = Depends(get_db)
 ):
-    if not current_user_id:
+    if not user:
         return RedirectResponse(url="/", status_code=303)
     
-    user = get_current_user(db)
     member = db.query(TeamMember).filter(TeamMember.id == member_id).first()
     
     if not member:
         raise HTTPException(status_code=404, detail="Member not found")
     
-    project = db.query(Project).filter(Project.id == member.project_id).first()
-    
-    if not (user.role in ['Admin', 'Professor'] or project.manager_id == user.id):
+    access = await resolve_project_access(request, user, member.project_id)
+    if not access.can_manage:
         return RedirectResponse(url=f"/projects/{member.project_id}", status_code=303)
     
     member.progress = progress
@@ -1319,13 +2497,20 @@ async def update_member_progress(
     
     return RedirectResponse(url=f"/projects/{member.project_id}", status_code=303)
 
+# Id of the general team members project, cached per process after the first lookup
+team_members_project_id = None
+
 def get_or_create_team_members_project(db: Session):
     """Get or create the general team members project"""
-    project = db.query(Project).filter(Project.name == "Membres d'équipe").first()
+    global team_members_project_id
+    project = db.get(Project, team_members_project_id) if team_members_project_id else None
+    if not project:
+        project = db.query(Project).filter(Project.is_system == true()).first()
     if not project:
         # Create the general team members project
         project = Project(
-            name="Membres d'équipe",
+            name=TEAM_MEMBERS_PROJECT_NAME,
+            is_system=True,
             type="Équipe générale",
             mission_objective="Gestion des membres de l'équipe étudiante approuvés",
             success_criteria="Tous les étudiants approuvés sont membres actifs",
@@ -1342,22 +2527,23 @@ def get_or_create_team_members_project(db: Session):
             phase = Phase(project_id=project.id, name=phase_name)
             db.add(phase)
         db.commit()
+    team_members_project_id = project.id
     return project
 
 @app.get("/students/{student_id}/approve")
-async def approve_student(student_id: int, db: Session = Depends(get_db)):
-    if not current_user_id:
+async def approve_student(student_id: int, user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_async_db)):
+    if not user:
         return RedirectResponse(url="/", status_code=303)
-    user = get_current_user(db)
     if not require_prof_or_admin(user):
         return RedirectResponse(url="/dashboard", status_code=303)
-    student = db.query(User).filter(User.id == student_id, User.role == "Student").first()
+    student = await db.scalar(select(User).where(User.id == student_id, User.role == "Student"))
     if not student:
         raise HTTPException(status_code=404, detail="Student not found")
     student.approval_status = "approved"
     student.approval_by_id = user.id
     student.approval_decision_at = datetime.utcnow()
-    db.commit()
+    await db.commit()
+    invalidate_cached_user(student.id)
 
     # Notify student
     if student.email:
@@ -1376,23 +2562,23 @@ Bienvenue dans notre communauté scientifique !
 
 Cordialement,
 L'équipe INTERSTELLAR CLUB"""
-        send_email(student.email, "🎉 Votre demande d'inscription a été acceptée - INTERSTELLAR CLUB", approval_body, email_type="acceptance")
+        await send_email(student.email, "🎉 Votre demande d'inscription a été acceptée - INTERSTELLAR CLUB", approval_body, email_type="acceptance")
     return RedirectResponse(url="/dashboard", status_code=303)
 
 @app.get("/students/{student_id}/reject")
-async def reject_student(student_id: int, db: Session = Depends(get_db)):
-    if not current_user_id:
+async def reject_student(student_id: int, user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_async_db)):
+    if not user:
         return RedirectResponse(url="/", status_code=303)
-    user = get_current_user(db)
     if not require_prof_or_admin(user):
         return RedirectResponse(url="/dashboard", status_code=303)
-    student = db.query(User).filter(User.id == student_id, User.role == "Student").first()
+    student = await db.scalar(select(User).where(User.id == student_id, User.role == "Student"))
     if not student:
         raise HTTPException(status_code=404, detail="Student not found")
     student.approval_status = "rejected"
     student.approval_by_id = user.id
     student.approval_decision_at = datetime.utcnow()
-    db.commit()
+    await db.commit()
+    invalidate_cached_user(student.id)
     # Notify student
     if student.email:
         rejection_body = f"""Cher/Chère {student.first_name} {student.last_name},
@@ -1408,30 +2594,25 @@ Nous vous remercions pour votre intérêt à rejoindre notre communauté scienti
 
 Cordialement,
 L'équipe INTERSTELLAR CLUB"""
-        send_email(student.email, "Demande d'inscription - INTERSTELLAR CLUB", rejection_body, email_type="rejection")
+        await send_email(student.email, "Demande d'inscription - INTERSTELLAR CLUB", rejection_body, email_type="rejection")
     return RedirectResponse(url="/dashboard", status_code=303)
 
 @app.post("/projects/{project_id}/upload")
 async def upload_file(
+    request: Request,
     project_id: int,
     file: UploadFile = File(...),
     description: str = Form(default=""),
-    db: Session = Depends(get_db)
+    user: CurrentUser = Depends(current_user),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    if not current_user_id:
+    if not user:
         return RedirectResponse(url="/", status_code=303)
     
-    user = get_current_user(db)
-    project = db.query(Project).filter(Project.id == project_id).first()
-    
-    is_manager = project.manager_id == user.id
-    is_team_member = db.query(TeamMember).filter(
-        TeamMember.project_id == project_id,
-        TeamMember.user_id == user.id
-    ).first() is not None
-    is_admin_or_prof = user.role in ['Admin', 'Professor']
-    
-    if not (is_manager or is_team_member or is_admin_or_prof):
+    access = await resolve_project_access(request, user, project_id)
+    if not access.exists:
+        raise HTTPException(status_code=404, detail="Project not found")
+    if not access.can_view:
         return RedirectResponse(url=f"/projects/{project_id}", status_code=303)
     
     allowed_extensions = ['.pdf', '.xlsx', '.xls', '.jpg', '.jpeg', '.png', '.doc', '.docx', '.txt', '.zip']
@@ -1460,29 +2641,21 @@ async def upload_file(
         description=description
     )
     db.add(project_file)
-    db.commit()
+    await db.commit()
     
     return RedirectResponse(url=f"/projects/{project_id}", status_code=303)
 
 @app.get("/files/{file_id}/download")
-async def download_file(file_id: int, db: Session = Depends(get_db)):
-    if not current_user_id:
+async def download_file(request: Request, file_id: int, user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_read_db)):
+    if not user:
         return RedirectResponse(url="/", status_code=303)
     
-    file = db.query(ProjectFile).filter(ProjectFile.id == file_id).first()
+    file = await db.get(ProjectFile, file_id)
     if not file:
         raise HTTPException(status_code=404, detail="File not found")
     
-    user = get_current_user(db)
-    project = db.query(Project).filter(Project.id == file.project_id).first()
-    is_manager = project.manager_id == user.id
-    is_team_member = db.query(TeamMember).filter(
-        TeamMember.project_id == file.project_id,
-        TeamMember.user_id == user.id
-    ).first() is not None
-    is_admin_or_prof = user.role in ['Admin', 'Professor']
-    
-    if not (is_manager or is_team_member or is_admin_or_prof):
+    access = await resolve_project_access(request, user, file.project_id)
+    if not access.can_view:
         raise HTTPException(status_code=403, detail="Access denied")
     
     return FileResponse(
@@ -1492,53 +2665,44 @@ async def download_file(file_id: int, db: Session = Depends(get_db)):
     )
 
 @app.post("/files/{file_id}/delete")
-async def delete_file(file_id: int, db: Session = Depends(get_db)):
-    if not current_user_id:
+async def delete_file(request: Request, file_id: int, user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_async_db)):
+    if not user:
         return RedirectResponse(url="/", status_code=303)
     
-    user = get_current_user(db)
-    file = db.query(ProjectFile).filter(ProjectFile.id == file_id).first()
+    file = await db.get(ProjectFile, file_id)
     
     if not file:
         raise HTTPException(status_code=404, detail="File not found")
     
-    project = db.query(Project).filter(Project.id == file.project_id).first()
-    
     is_owner = file.uploaded_by == user.id
-    is_manager = project.manager_id == user.id
-    is_admin_or_prof = user.role in ['Admin', 'Professor']
+    access = await resolve_project_access(request, user, file.project_id)
     
-    if not (is_owner or is_manager or is_admin_or_prof):
+    if not (is_owner or access.can_manage):
         return RedirectResponse(url=f"/projects/{file.project_id}", status_code=303)
     
     if os.path.exists(file.file_path):
         os.remove(file.file_path)
     
-    db.delete(file)
-    db.commit()
+    await db.delete(file)
+    await db.commit()
     
     return RedirectResponse(url=f"/projects/{file.project_id}", status_code=303)
 
 @app.post("/projects/{project_id}/messages")
 async def send_message(
+    request: Request,
     project_id: int,
     content: str = Form(...),
-    db: Session = Depends(get_db)
+    user: CurrentUser = Depends(current_user),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    if not current_user_id:
+    if not user:
         return RedirectResponse(url="/", status_code=303)
     
-    user = get_current_user(db)
-    
-    project = db.query(Project).filter(Project.id == project_id).first()
-    is_manager = project.manager_id == user.id
-    is_team_member = db.query(TeamMember).filter(
-        TeamMember.project_id == project_id,
-        TeamMember.user_id == user.id
-    ).first() is not None
-    is_admin_or_prof = user.role in ['Admin', 'Professor']
-    
-    if not (is_manager or is_team_member or is_admin_or_prof):
+    access = await resolve_project_access(request, user, project_id)
+    if not access.exists:
+        raise HTTPException(status_code=404, detail="Project not found")
+    if not access.can_view:
         return RedirectResponse(url=f"/projects/{project_id}", status_code=303)
     
     message = Message(
@@ -1547,7 +2711,7 @@ async def send_message(
         content=content
     )
     db.add(message)
-    db.commit()
+    await db.commit()
     
     return RedirectResponse(url=f"/projects/{project_id}#chat", status_code=303)
 
@@ -1590,20 +2754,29 @@ async def create_risk(
     return RedirectResponse(url=f"/projects/{project_id}", status_code=303)
 
 @app.get("/logout")
-async def logout():
-    global current_user_id
-    current_user_id = None
-    return RedirectResponse(url="/", status_code=303)
+async def logout(request: Request):
+    response = RedirectResponse(url="/", status_code=303)
+    await end_session(request, response)
+    return response
+
+@app.get("/email/quota")
+async def email_quota(user: CurrentUser = Depends(current_user)):
+    """Email sending quota usage and outbox backlog (professors and admins)"""
+    if not require_prof_or_admin(user):
+        raise HTTPException(status_code=403, detail="Access denied")
+    return await asyncio.get_running_loop().run_in_executor(None, email_quota_report)
 
 @app.post("/update-profile-image")
 async def update_profile_image(
     profile_image: UploadFile = File(...),
-    db: Session = Depends(get_db)
+    user: CurrentUser = Depends(current_user),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    if not current_user_id:
+    if not user:
         return {"success": False, "message": "Utilisateur non connecté"}
 
-    user = get_current_user(db)
+    # Re-load the user in the write session so the new image path can be committed
+    user = await db.get(User, user.id)
     if not user:
         return {"success": False, "message": "Utilisateur non trouvé"}
 
@@ -1633,7 +2806,8 @@ async def update_profile_image(
         # تحديث قاعدة البيانات - حفظ المسار النسبي للويب
         web_path = f"uploads/profile_images/{safe_name}"
         user.profile_image = web_path
-        db.commit()
+        await db.commit()
+        invalidate_cached_user(user.id)
 
         return {"success": True, "message": "Photo de profil mise à jour avec succès"}
 
@@ -1642,11 +2816,10 @@ async def update_profile_image(
         return {"success": False, "message": "Erreur lors de la mise à jour"}
 
 @app.post("/projects/{project_id}/delete")
-async def delete_project(project_id: int, db: Session = Depends(get_db)):
-    if not current_user_id:
+async def delete_project(project_id: int, user: CurrentUser = Depends(current_user), db: Session = Depends(get_db)):
+    if not user:
         return RedirectResponse(url="/", status_code=303)
 
-    user = get_current_user(db)
     project = db.query(Project).filter(Project.id == project_id).first()
 
     if not project:
@@ -1664,6 +2837,7 @@ async def delete_project(project_id: int, db: Session = Depends(get_db)):
     # Delete project from database (will cascade delete related records)
     db.delete(project)
     db.commit()
+    invalidate_project_access(project_id)
 
     return RedirectResponse(url="/dashboard", status_code=303)
 
@@ -1673,6 +2847,20 @@ if __name__ == "__main__":
     import subprocess
     import sys
 
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        applied = migrate()
+        print(f"Database schema at version {SCHEMA_HEAD} (applied: {applied or 'nothing, already up to date'})")
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == "calibrate-hash":
+        target_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 50.0
+        time_cost, memory_cost, parallelism, elapsed = calibrate_argon2(target_ms)
+        print(f"argon2id verify takes {elapsed:.1f} ms on this machine (target {target_ms:.0f} ms); set:")
+        print(f"ARGON2_TIME_COST={time_cost}")
+        print(f"ARGON2_MEMORY_COST={memory_cost}")
+        print(f"ARGON2_PARALLELISM={parallelism}")
+        sys.exit(0)
+
     # استخدام منفذ مختلف إذا كان المنفذ 8000 مشغولاً
     port = int(os.getenv("PORT", "8000"))
 
@@ -0,0 +1,147 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+import aiosmtplib
+from sqlalchemy import delete
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def outbox(monkeypatch):
+    main.check_schema_version()
+    with main.SessionLocal() as db:
+        db.execute(delete(main.EmailOutbox))
+        db.execute(delete(main.EmailSendingPause))
+        db.commit()
+    monkeypatch.setitem(main.email_governor, "notice", None)
+
+
+def claimed_message(email_type="general", body="hello", age=timedelta(0)):
+    """An outbox row as claim_outbox_messages() hands it to the sender"""
+    with main.SessionLocal() as db:
+        message = main.EmailOutbox(
+            recipients=json.dumps(["prof@univ.dz"]), subject="s", body=body, email_type=email_type,
+            status="sending", claim_token="token", created_at=datetime.utcnow() - age,
+        )
+        db.add(message)
+        db.commit()
+        db.refresh(message)
+        db.expunge(message)
+        return message
+
+
+def queue(subject, priority):
+    with main.SessionLocal() as db:
+        db.add(main.outbox_message(["prof@univ.dz"], subject, "body", priority=priority))
+        db.commit()
+
+
+def deliver(message, monkeypatch, error=None, during_send=None):
+    calls = []
+
+    async def fake_deliver_email(*args):
+        calls.append(args)
+        if during_send is not None:
+            during_send()
+        if error is not None:
+            raise error
+
+    monkeypatch.setattr(main, "deliver_email", fake_deliver_email)
+    asyncio.run(main.deliver_outbox_message(message))
+    with main.SessionLocal() as db:
+        return db.get(main.EmailOutbox, message.id), calls
+
+
+def test_expired_verification_code_is_dead_lettered_without_sending(monkeypatch):
+    message = claimed_message("verification_code", "123456", age=timedelta(seconds=main.VERIFICATION_CODE_TTL + 1))
+    row, calls = deliver(message, monkeypatch)
+    assert calls == []
+    assert row.status == "dead" and row.body == ""
+
+
+def test_verification_code_is_not_retried_past_its_expiry(monkeypatch):
+    error = aiosmtplib.SMTPServerDisconnected("connection lost")
+    row, _ = deliver(claimed_message("verification_code", "123456"), monkeypatch, error)
+    assert row.status == "pending" and row.body == "123456"
+
+    # The code expires while the failing attempt is in flight
+    class LaterDatetime(datetime):
+        @classmethod
+        def utcnow(cls):
+            return datetime.utcnow() + timedelta(seconds=main.VERIFICATION_CODE_TTL)
+
+    expire = lambda: monkeypatch.setattr(main, "datetime", LaterDatetime)
+    row, calls = deliver(claimed_message("verification_code", "654321"), monkeypatch, error, during_send=expire)
+    assert len(calls) == 1
+    assert row.status == "dead" and row.body == "" and row.attempts == 1
+
+
+def test_message_size_rejection_is_retried_not_treated_as_quota(monkeypatch):
+    error = aiosmtplib.SMTPDataError(552, "5.2.3 Your message exceeded Google's message size limits. Please visit https://support.google.com/mail/?p=MaxSizeError")
+    row, _ = deliver(claimed_message(), monkeypatch, error)
+    with main.SessionLocal() as db:
+        assert main.sending_paused_until(db, datetime.utcnow()) is None
+    assert row.status == "pending" and row.attempts == 1
+
+    monkeypatch.setattr(main, "EMAIL_MAX_ATTEMPTS", 1)
+    row, _ = deliver(claimed_message(), monkeypatch, error)
+    assert row.status == "dead"
+
+
+def test_daily_sending_limit_pauses_delivery_without_using_an_attempt(monkeypatch):
+    error = aiosmtplib.SMTPDataError(550, "5.4.5 Daily user sending limit exceeded. For more information on Gmail sending limits go to https://support.google.com/a/answer/166852")
+    row, _ = deliver(claimed_message(), monkeypatch, error)
+    with main.SessionLocal() as db:
+        paused_until = main.sending_paused_until(db, datetime.utcnow())
+    assert paused_until is not None
+    assert row.status == "pending" and row.attempts == 0
+    assert row.next_attempt_at == paused_until
+
+    # The pause lives in the database, so a worker that never saw the reply stops claiming too
+    main.email_governor["notice"] = None
+    queue("approval", main.EMAIL_PRIORITY_NORMAL)
+    assert main.claim_outbox_messages() == []
+    assert "paused" in main.email_governor["notice"]
+
+
+def test_claims_follow_priority_order():
+    for i in range(3):
+        queue(f"notice {i}", main.EMAIL_PRIORITY_LOW)
+    queue("code", main.EMAIL_PRIORITY_HIGH)
+    queue("approval", main.EMAIL_PRIORITY_NORMAL)
+    assert [message.subject for message in main.claim_outbox_messages(1)] == ["code"]
+    assert [message.subject for message in main.claim_outbox_messages()] == ["approval", "notice 0", "notice 1", "notice 2"]
+
+
+def test_slow_delivery_does_not_hold_back_new_messages(monkeypatch):
+    monkeypatch.setattr(main, "EMAIL_SMTP_POOL_SIZE", 2)
+    sent = []
+
+    async def fake_deliver_email(recipients, subject, *args):
+        if subject == "slow notice":
+            await asyncio.Event().wait()  # a connection that never answers
+        sent.append(subject)
+
+    monkeypatch.setattr(main, "deliver_email", fake_deliver_email)
+
+    async def scenario():
+        wakeup = asyncio.Event()
+        sender = asyncio.create_task(main.run_email_outbox(wakeup))
+        queue("slow notice", main.EMAIL_PRIORITY_LOW)
+        wakeup.set()
+        await asyncio.sleep(0.5)
+        queue("code", main.EMAIL_PRIORITY_HIGH)
+        wakeup.set()
+        for _ in range(50):
+            if sent:
+                break
+            await asyncio.sleep(0.1)
+        sender.cancel()
+        await asyncio.gather(sender, return_exceptions=True)
+
+    asyncio.run(scenario())
+    assert sent == ["code"]
@@ -0,0 +1,151 @@
+import pytest
+from sqlalchemy import create_engine, inspect
+
+import main
+
+# Schema of a database created by the last release before versioned migrations
+LEGACY_SCHEMA = """
+CREATE TABLE users (
+    id INTEGER NOT NULL,
+    first_name VARCHAR,
+    last_name VARCHAR,
+    username VARCHAR,
+    email VARCHAR,
+    phone_number VARCHAR,
+    hashed_password VARCHAR,
+    role VARCHAR,
+    gender VARCHAR,
+    student_id_number VARCHAR,
+    birth_place VARCHAR,
+    birth_date DATETIME,
+    student_card_image VARCHAR,
+    specialty VARCHAR,
+    profile_image VARCHAR,
+    approval_status VARCHAR,
+    approval_by_id INTEGER,
+    approval_decision_at DATETIME,
+    created_at DATETIME,
+    PRIMARY KEY (id),
+    FOREIGN KEY(approval_by_id) REFERENCES users (id)
+);
+CREATE UNIQUE INDEX ix_users_email ON users (email);
+CREATE INDEX ix_users_id ON users (id);
+CREATE UNIQUE INDEX ix_users_username ON users (username);
+CREATE TABLE projects (
+    id INTEGER NOT NULL,
+    name VARCHAR,
+    type VARCHAR,
+    mission_objective TEXT,
+    success_criteria TEXT,
+    manager_id INTEGER,
+    start_date DATETIME,
+    end_date DATETIME,
+    status VARCHAR,
+    overall_progress INTEGER,
+    created_at DATETIME,
+    PRIMARY KEY (id),
+    FOREIGN KEY(manager_id) REFERENCES users (id)
+);
+CREATE INDEX ix_projects_id ON projects (id);
+CREATE INDEX ix_projects_name ON projects (name);
+CREATE TABLE phases (
+    id INTEGER NOT NULL,
+    project_id INTEGER,
+    name VARCHAR,
+    status VARCHAR,
+    responsible VARCHAR,
+    validation VARCHAR,
+    notes TEXT,
+    completed_date DATETIME,
+    PRIMARY KEY (id),
+    FOREIGN KEY(project_id) REFERENCES projects (id)
+);
+CREATE INDEX ix_phases_id ON phases (id);
+CREATE TABLE risks (
+    id INTEGER NOT NULL,
+    project_id INTEGER,
+    description TEXT,
+    probability VARCHAR,
+    severity VARCHAR,
+    mitigation TEXT,
+    status VARCHAR,
+    PRIMARY KEY (id),
+    FOREIGN KEY(project_id) REFERENCES projects (id)
+);
+CREATE INDEX ix_risks_id ON risks (id);
+CREATE TABLE team_members (
+    id INTEGER NOT NULL,
+    project_id INTEGER,
+    user_id INTEGER,
+    role VARCHAR,
+    responsibilities TEXT,
+    progress INTEGER,
+    added_at DATETIME,
+    PRIMARY KEY (id),
+    FOREIGN KEY(project_id) REFERENCES projects (id),
+    FOREIGN KEY(user_id) REFERENCES users (id)
+);
+CREATE INDEX ix_team_members_id ON team_members (id);
+CREATE TABLE project_files (
+    id INTEGER NOT NULL,
+    project_id INTEGER,
+    filename VARCHAR,
+    original_filename VARCHAR,
+    file_type VARCHAR,
+    file_path VARCHAR,
+    uploaded_by INTEGER,
+    uploaded_at DATETIME,
+    description TEXT,
+    PRIMARY KEY (id),
+    FOREIGN KEY(project_id) REFERENCES projects (id),
+    FOREIGN KEY(uploaded_by) REFERENCES users (id)
+);
+CREATE INDEX ix_project_files_id ON project_files (id);
+CREATE TABLE messages (
+    id INTEGER NOT NULL,
+    project_id INTEGER,
+    user_id INTEGER,
+    content TEXT,
+    created_at DATETIME,
+    PRIMARY KEY (id),
+    FOREIGN KEY(project_id) REFERENCES projects (id),
+    FOREIGN KEY(user_id) REFERENCES users (id)
+);
+CREATE INDEX ix_messages_id ON messages (id);
+"""
+
+
+@pytest.fixture
+def legacy_engine(tmp_path, monkeypatch):
+    legacy_engine = create_engine(f"sqlite:///{tmp_path}/legacy.db")
+    with legacy_engine.begin() as conn:
+        for statement in LEGACY_SCHEMA.split(";"):
+            if statement.strip():
+                conn.exec_driver_sql(statement)
+        conn.exec_driver_sql(
+            "INSERT INTO users (id, username, email, role, approval_status, created_at) "
+            "VALUES (1, 'student', 'student@x.dz', 'Student', 'pending', '2025-01-01 00:00:00')"
+        )
+    monkeypatch.setattr(main, "engine", legacy_engine)
+    yield legacy_engine
+    legacy_engine.dispose()
+
+
+def test_legacy_database_migrates_to_head(legacy_engine):
+    assert main.migrate() == [number for number, _, _ in main.MIGRATIONS]
+    with legacy_engine.connect() as conn:
+        assert main.get_schema_version(conn) == main.SCHEMA_HEAD
+        # Registrations from before the digest existed were already emailed to the professors
+        assert conn.exec_driver_sql("SELECT registration_notified_at FROM users WHERE id = 1").scalar() is not None
+        # The upgraded schema has every column and index of a freshly created one
+        schema = inspect(conn)
+        for table in main.Base.metadata.sorted_tables:
+            assert {column.name for column in table.columns} <= {column["name"] for column in schema.get_columns(table.name)}
+            assert {index.name for index in table.indexes} <= {index["name"] for index in schema.get_indexes(table.name)}
+
+
+def test_migrate_twice_is_a_no_op(legacy_engine):
+    main.migrate()
+    assert main.migrate() == []
+    with legacy_engine.connect() as conn:
+        assert main.get_schema_version(conn) == main.SCHEMA_HEAD
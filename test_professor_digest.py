@@ -0,0 +1,83 @@
+import json
+from datetime import timedelta
+
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def digest_db(tmp_path, monkeypatch):
+    """A database of its own, so users created by other test modules do not show up here"""
+    digest_engine = create_engine(f"sqlite:///{tmp_path}/digest.db")
+    main.Base.metadata.create_all(digest_engine)
+    monkeypatch.setattr(main, "SessionLocal", sessionmaker(bind=digest_engine, autoflush=False))
+    monkeypatch.setenv("BASE_URL", "https://club.example")
+    yield
+    digest_engine.dispose()
+
+
+def add_users(*users):
+    with main.SessionLocal() as db:
+        db.add_all(users)
+        db.commit()
+
+
+def student(username, card=None):
+    return main.User(username=username, email=f"{username}@x.dz", first_name="S", last_name=username, role="Student", approval_status="pending", student_card_image=card)
+
+
+def digests():
+    with main.SessionLocal() as db:
+        return db.scalars(select(main.EmailOutbox).where(main.EmailOutbox.email_type == "notification")).all()
+
+
+def expire_interval():
+    with main.SessionLocal() as db:
+        state = db.get(main.NotificationDigest, main.PROFESSOR_DIGEST_NAME)
+        state.sent_at -= timedelta(seconds=main.PROFESSOR_DIGEST_INTERVAL + 1)
+        db.commit()
+
+
+def test_each_registration_is_reported_once():
+    add_users(main.User(username="prof", email="prof@univ.dz", role="Professor"), student("a"), student("b"))
+    assert main.queue_professor_digest() == 2
+    expire_interval()
+    assert main.queue_professor_digest() == 0
+
+    add_users(student("c"))
+    expire_interval()
+    assert main.queue_professor_digest() == 1
+    bodies = [message.body for message in digests()]
+    assert len(bodies) == 2 and "(c)" in bodies[1] and "(a)" not in bodies[1]
+
+
+def test_digest_waits_for_the_interval():
+    add_users(main.User(username="prof", email="prof@univ.dz", role="Professor"), student("a"))
+    assert main.queue_professor_digest() == 1
+    add_users(student("b"))
+    assert main.queue_professor_digest() == 0
+    expire_interval()
+    assert main.queue_professor_digest() == 1
+
+
+def test_nothing_is_marked_without_professors():
+    add_users(student("a"))
+    assert main.queue_professor_digest() == 0
+    assert digests() == []
+    with main.SessionLocal() as db:
+        assert db.scalar(select(main.User.registration_notified_at)) is None
+        assert db.get(main.NotificationDigest, main.PROFESSOR_DIGEST_NAME) is None
+
+    add_users(main.User(username="prof", email="prof@univ.dz", role="Professor"))
+    assert main.queue_professor_digest() == 1
+
+
+def test_card_links_are_url_encoded():
+    add_users(main.User(username="prof", email="prof@univ.dz", role="Professor"), student("a", "uploads\\student_cards\\Capture d’écran 2025-12-22 225902.png"))
+    main.queue_professor_digest()
+    [message] = digests()
+    assert "https://club.example/uploads/student_cards/Capture%20d%E2%80%99%C3%A9cran%202025-12-22%20225902.png" in message.body
+    assert json.loads(message.attachments) == []
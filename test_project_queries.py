@@ -0,0 +1,63 @@
+import pytest
+
+pytest.importorskip("httpx")
+
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+import main
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+def create_project(member_count, message_count, file_count):
+    db = main.SessionLocal()
+    try:
+        manager = main.User(username=f"manager{member_count}", email=f"manager{member_count}@univ.dz", hashed_password=main.pwd_context.hash("secret"), role="Professor", approval_status="approved")
+        db.add(manager)
+        db.flush()
+        project = main.Project(name=f"Project {member_count}", type="Tech", mission_objective="", success_criteria="", manager_id=manager.id)
+        db.add(project)
+        db.flush()
+        members = []
+        for i in range(member_count):
+            student = main.User(username=f"student{member_count}_{i}", email=f"s{member_count}_{i}@x.dz", first_name="S", last_name=str(i), role="Student", approval_status="approved")
+            db.add(student)
+            db.flush()
+            db.add(main.TeamMember(project_id=project.id, user_id=student.id, role="Dev"))
+            members.append(student)
+        for i in range(message_count):
+            db.add(main.Message(project_id=project.id, user_id=members[i % member_count].id, content=f"message {i}"))
+        for i in range(file_count):
+            db.add(main.ProjectFile(project_id=project.id, filename=f"f{i}.txt", original_filename=f"f{i}.txt", file_type=".txt", file_path=f"f{i}.txt", uploaded_by=members[i % member_count].id))
+        db.commit()
+        return manager.username, project.id
+    finally:
+        db.close()
+
+
+def count_project_detail_queries(client, manager_username, project_id):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    client.post("/login", data={"username": manager_username, "password": "secret"}, follow_redirects=False)
+    event.listen(main.read_async_engine.sync_engine, "before_cursor_execute", record)
+    try:
+        response = client.get(f"/projects/{project_id}")
+    finally:
+        event.remove(main.read_async_engine.sync_engine, "before_cursor_execute", record)
+        client.get("/logout", follow_redirects=False)
+    assert response.status_code == 200
+    return len(statements)
+
+
+def test_project_detail_query_count_is_constant(client):
+    small = count_project_detail_queries(client, *create_project(member_count=2, message_count=3, file_count=1))
+    large = count_project_detail_queries(client, *create_project(member_count=25, message_count=400, file_count=30))
+    assert small == large
@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("httpx")
+
+from fastapi.testclient import TestClient
+
+import main
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+def test_login_account_limit_returns_429_with_retry_after(client):
+    capacity, period = main.rate_limit_rule("login", "account")
+    for _ in range(capacity):
+        response = client.post("/login", data={"username": "ratelimited", "password": "wrong"}, follow_redirects=False)
+        assert response.status_code == 303
+
+    response = client.post("/login", data={"username": "RateLimited", "password": "wrong"}, follow_redirects=False)
+    assert response.status_code == 429
+    assert 1 <= int(response.headers["Retry-After"]) <= period
+    assert response.json()["success"] is False
+
+    response = client.post("/login", data={"username": "ratelimited", "password": "wrong"}, headers={"Accept": "text/html"}, follow_redirects=False)
+    assert response.status_code == 429
+    assert response.headers["content-type"].startswith("text/html")
+
+    # Another account from the same address is not affected
+    response = client.post("/login", data={"username": "someone-else", "password": "wrong"}, follow_redirects=False)
+    assert response.status_code == 303
+
+
+def test_memory_store_refills_over_time(monkeypatch):
+    store = main.MemoryRateLimitStore()
+    clock = [1000.0]
+    monkeypatch.setattr(main.time, "time", lambda: clock[0])
+    assert asyncio.run(store.take("k", 2, 60)) == 0
+    assert asyncio.run(store.take("k", 2, 60)) == 0
+    assert asyncio.run(store.take("k", 2, 60)) == pytest.approx(30)
+    clock[0] += 30
+    assert asyncio.run(store.take("k", 2, 60)) == 0